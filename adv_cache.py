@@ -0,0 +1,110 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from collections import OrderedDict, namedtuple
+
+import torch
+
+'''
+Cache of the BSS adversarial samples of train_bss.py (--adv_cache).
+
+The teacher is frozen, so the attack of a sample only depends on its augmentation
+and on the attack class. Training replays a fixed set of augmentations per sample
+(teacher_cache.ReplayAugDataset) and the cache keeps, per (index, variant, attack
+class), the perturbation found by BSSAttacker and the teacher logits of the
+adversarial sample. Perturbations are stored as fp16 or as int8 with one fp32 scale
+per sample, logits as fp16. The cache is bounded in bytes and evicts the least
+recently used entries; with max_age an entry is recomputed after that many epochs.
+'''
+
+ADV_DTYPES = ('fp16', 'int8')
+
+AdvEntry = namedtuple('AdvEntry', ['delta', 'scale', 'out_t', 'epoch', 'nbytes'])
+
+
+class AdvCache(object):
+    def __init__(self, max_bytes, dtype='fp16', max_age=0):
+        if dtype not in ADV_DTYPES:
+            raise Exception('Invalid adversarial cache dtype {}...'.format(dtype))
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evicted = 0
+
+    @staticmethod
+    def keys(index, variant, attack_class):
+        return list(zip(index.tolist(), variant.tolist(), attack_class.tolist()))
+
+    def fetch(self, keys, epoch):
+        '''
+        Returns the positions of the cached keys, their perturbations and teacher
+        logits (fp32, on the CPU), or None for both if nothing is cached.
+        '''
+        hits, deltas, outs = [], [], []
+        for i, key in enumerate(keys):
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                continue
+            if self.max_age and epoch - entry.epoch >= self.max_age:
+                self._remove(key)
+                self.stale += 1
+                self.misses += 1
+                continue
+            self.entries.move_to_end(key)
+            self.hits += 1
+            hits.append(i)
+            delta = entry.delta.float()
+            if entry.scale is not None:
+                delta = delta * entry.scale
+            deltas.append(delta)
+            outs.append(entry.out_t.float())
+        if not hits:
+            return hits, None, None
+        return hits, torch.stack(deltas), torch.stack(outs)
+
+    def store(self, keys, delta, out_t, epoch):
+        # delta: the perturbations of the batch, out_t: the teacher logits of the
+        # adversarial samples
+        delta = delta.detach().float().cpu()
+        out_t = out_t.detach().half().cpu()
+        scale = None
+        if self.dtype == 'int8':
+            scale = delta.abs().flatten(1).amax(dim=1).clamp(min=1e-8) / 127.0
+            scale = scale.view((-1,) + (1,) * (delta.dim() - 1))
+            delta = (delta / scale).round_().clamp_(-127, 127).to(torch.int8)
+        else:
+            delta = delta.half()
+
+        for i, key in enumerate(keys):
+            if key in self.entries:
+                self._remove(key)
+            s = None if scale is None else scale[i].clone()
+            d, o = delta[i].clone(), out_t[i].clone()
+            nbytes = d.numel() * d.element_size() + o.numel() * o.element_size() + (4 if s is not None else 0)
+            self.entries[key] = AdvEntry(d, s, o, epoch, nbytes)
+            self.nbytes += nbytes
+        while self.nbytes > self.max_bytes and self.entries:
+            self._remove(next(iter(self.entries)))
+            self.evicted += 1
+
+    def _remove(self, key):
+        self.nbytes -= self.entries.pop(key).nbytes
+
+    def summary(self):
+        total = max(self.hits + self.misses, 1)
+        return ('Adversarial cache: {} entries, {:.1f}MB, hits {} ({:.1f}%), misses {}, '
+                'stale {}, evicted {}'.format(len(self), self.nbytes / 1e6, self.hits,
+                                              100.0 * self.hits / total, self.misses,
+                                              self.stale, self.evicted))
@@ -0,0 +1,397 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+from kd_losses.st import SoftTarget, SparseSoftTarget, topk_logits
+from dataUtils.augment import BatchAugment
+from dataset import CRDSampleCollate
+from kd_losses.crd import ContrastMemory
+from kd_losses.bss import sample_attack_class
+from kd_losses.nst import NST
+from utils import define_tsnet, load_pretrained_model
+from engine import KD_MODES, Teacher
+from teacher_weights import export_shared_weights, load_shared_weights
+
+'''
+Micro-benchmarks for the performance related parts of this repo.
+Run `python benchmark.py <name> -h` for the options of each benchmark.
+'''
+
+
+def bench_topk(args):
+    '''
+    Size and fidelity of the top-k teacher logit store against dense fp16 logits.
+    Teacher logits are read from the first chunk of a dense fp16 teacher cache (see
+    teacher_cache.py) if given, otherwise they are random.
+    Student logits are the teacher logits plus noise.
+    The loss error and gradient cosine stand in for the accuracy of the student, see
+    the top-k SoftTarget runs of example_train_script.sh for that.
+    '''
+    if args.cache:
+        out_t = np.load(os.path.join(args.cache, 'out.0000.npy'), mmap_mode='r')
+        out_t = out_t.reshape(-1, out_t.shape[-1])[:args.num]
+        out_t = torch.from_numpy(out_t.astype(np.float32))
+    else:
+        out_t = torch.randn(args.num, args.num_class) * 3.0
+    num_class = out_t.size(1)
+    out_s = out_t + args.noise * torch.randn_like(out_t)
+
+    dense = SoftTarget(args.T)
+    sparse = SparseSoftTarget(args.T)
+
+    out_s.requires_grad_(True)
+    loss_dense = dense(out_s, out_t)
+    grad_dense = torch.autograd.grad(loss_dense, out_s)[0].view(-1)
+
+    idx_bytes = 2 if num_class <= np.iinfo(np.int16).max else 4
+    print('classes: {}, samples: {}, T: {}'.format(num_class, out_t.size(0), args.T))
+    print('{:>6} {:>12} {:>10} {:>12} {:>12}'.format('k', 'bytes/sample', 'ratio', 'loss err(%)', 'grad cos'))
+    print('{:>6} {:>12} {:>10.3f} {:>12} {:>12}'.format('dense', 2 * num_class, 1.0, '-', '-'))
+    for k in args.k:
+        if k >= num_class:
+            continue
+        loss_sparse = sparse(out_s, topk_logits(out_t, k, args.T))
+        grad_sparse = torch.autograd.grad(loss_sparse, out_s)[0].view(-1)
+        nbytes = 2 * k + idx_bytes * k + 4
+        err = (loss_sparse - loss_dense).abs().item() / loss_dense.item() * 100
+        cos = F.cosine_similarity(grad_sparse, grad_dense, dim=0).item()
+        print('{:>6} {:>12} {:>10.3f} {:>12.3f} {:>12.5f}'.format(k, nbytes, nbytes / (2 * num_class), err, cos))
+
+
+def bench_augment(args):
+    '''
+    Per-sample torchvision transforms against BatchAugment on random CIFAR sized images,
+    both on a single CPU thread (the per-sample numbers exclude DataLoader overhead).
+    '''
+    from PIL import Image
+    import torchvision.transforms as transforms
+
+    torch.set_num_threads(1)
+    mean, std = (0.5071, 0.4865, 0.4409), (0.2673, 0.2564, 0.2762)
+    data = torch.randint(0, 256, (args.batch_size, 32, 32, 3), dtype=torch.uint8)
+    per_sample = transforms.Compose([
+        transforms.RandomCrop(32, padding=4, padding_mode='reflect'),
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomRotation(args.rotation),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=mean, std=std),
+    ])
+    batched = BatchAugment(mean, std, padding=4, flip=True, rotation=args.rotation)
+
+    images = [Image.fromarray(img) for img in data.numpy()]
+    start = time.time()
+    for _ in range(args.iters):
+        torch.stack([per_sample(img) for img in images])
+    t_sample = (time.time() - start) / args.iters
+
+    start = time.time()
+    for _ in range(args.iters):
+        batched(data)
+    t_batch = (time.time() - start) / args.iters
+
+    print('batch size: {}, rotation: {}'.format(args.batch_size, args.rotation))
+    print('per-sample: {:.2f}ms/batch, batched: {:.2f}ms/batch, speedup: {:.1f}x'.format(
+        t_sample * 1000, t_batch * 1000, t_sample / t_batch))
+
+
+def bench_crd_sample(args):
+    '''
+    CRD negative sampling for one batch: np.random.choice over the dense per-class
+    negative lists for every sample against CRDSampleCollate.
+    '''
+    labels = np.random.randint(0, args.num_class, size=args.n_data)
+    target = torch.from_numpy(labels[:args.batch_size])
+    index = torch.arange(args.batch_size)
+
+    start = time.time()
+    cls_negative = [np.where(labels != c)[0] for c in range(args.num_class)]
+    t_build_dense = time.time() - start
+    start = time.time()
+    collate = CRDSampleCollate(labels, args.num_class, n=args.nce_n)
+    t_build_index = time.time() - start
+
+    start = time.time()
+    for _ in range(args.iters):
+        for t in target.tolist():
+            np.random.choice(cls_negative[t], args.nce_n, replace=False)
+    t_dense = (time.time() - start) / args.iters
+
+    start = time.time()
+    for _ in range(args.iters):
+        collate((None, target, index))
+    t_index = (time.time() - start) / args.iters
+
+    print('n_data: {}, classes: {}, nce_n: {}, batch size: {}'.format(
+        args.n_data, args.num_class, args.nce_n, args.batch_size))
+    print('build: dense lists {:.1f}ms, class index {:.1f}ms'.format(t_build_dense * 1000, t_build_index * 1000))
+    print('per-sample: {:.2f}ms/batch, vectorized: {:.2f}ms/batch, speedup: {:.1f}x'.format(
+        t_dense * 1000, t_index * 1000, t_dense / t_index))
+
+
+def bench_crd_memory(args):
+    '''
+    Time and peak memory of one ContrastMemory forward + backward for the storage
+    types and gather-score chunk sizes (0 is the unfused index_select + bmm).
+    Peak memory is only reported on CUDA.
+    '''
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    sample_idx = torch.randint(0, args.n_data, (args.batch_size, args.nce_n + 1), device=device)
+    idx = sample_idx[:, 0].contiguous()
+
+    print('n_data: {}, feat_dim: {}, nce_n: {}, batch size: {}, device: {}'.format(
+        args.n_data, args.feat_dim, args.nce_n, args.batch_size, device))
+    print('{:>6} {:>6} {:>10} {:>12} {:>10}'.format('dtype', 'chunk', 'bank(MB)', 'peak(MB)', 'ms/iter'))
+    for mem_dtype in args.mem_dtype:
+        for chunk in args.chunk:
+            memory = ContrastMemory(args.feat_dim, args.n_data, args.nce_n, 0.1, 0.5,
+                                    mem_dtype=mem_dtype, chunk=chunk).to(device)
+            bank = 2 * memory.memory_s.numel() * memory.memory_s.element_size() / 1e6
+            if device == 'cuda':
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+                base = torch.cuda.memory_allocated()
+            start = time.time()
+            for _ in range(args.iters):
+                feat_s = F.normalize(torch.randn(args.batch_size, args.feat_dim, device=device), dim=1)
+                feat_t = F.normalize(torch.randn(args.batch_size, args.feat_dim, device=device), dim=1)
+                feat_s.requires_grad_(True)
+                feat_t.requires_grad_(True)
+                out_s, out_t = memory(feat_s, feat_t, idx, sample_idx)
+                (out_s.sum() + out_t.sum()).backward()
+            memory.flush()
+            peak = '-'
+            if device == 'cuda':
+                torch.cuda.synchronize()
+                peak = '{:.1f}'.format((torch.cuda.max_memory_allocated() - base) / 1e6)
+            t = (time.time() - start) / args.iters
+            print('{:>6} {:>6} {:>10.1f} {:>12} {:>10.2f}'.format(mem_dtype, chunk, bank, peak, t * 1000))
+
+
+def bench_teacher(args):
+    '''
+    CUDA memory of one teacher forward per kd mode: every output kept in the autograd
+    context against engine.Teacher, which runs under inference mode and only copies
+    out the taps of the mode (sobolev/lwm keep autograd).
+    '''
+    if not torch.cuda.is_available():
+        print('teacher memory is only measured on CUDA')
+        return
+    tnet = define_tsnet(args.t_name, args.num_class, cuda=True, return_features=False)
+    tnet.eval()
+    for param in tnet.parameters():
+        param.requires_grad = False
+
+    print('teacher: {}, batch size: {}'.format(args.t_name, args.batch_size))
+    print('{:>8} {:>26} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'mode', 'taps', 'full peak', 'full kept', 'peak', 'kept', 'saved'))
+    for mode, kd in KD_MODES.items():
+        grad = getattr(kd.cls, 'teacher_grad', False)
+        img = torch.randn(args.batch_size, 3, 32, 32, device='cuda', requires_grad=grad)
+        memory = Teacher(tnet, kd.cls.taps, grad).memory(img)
+        (full_peak, full_kept), (peak, kept) = memory['full'], memory['taps']
+        print('{:>8} {:>26} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            mode, ','.join(kd.cls.taps), full_peak, full_kept, peak, kept, full_peak - peak))
+
+
+def bench_bss_sample(args):
+    '''
+    BSS attack class sampling for one batch: the per-element loop of the original
+    train_bss.py (one host sync per comparison) against sample_attack_class.
+    '''
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print('classes: {}, device: {}'.format(args.num_class, device))
+    print('{:>12} {:>12} {:>12} {:>10}'.format('attack_size', 'loop(ms)', 'vector(ms)', 'speedup'))
+    for attack_size in args.attack_size:
+        out_t = torch.randn(attack_size, args.num_class, device=device) * 3.0
+        class_score, class_idx = F.softmax(out_t, 1).sort(dim=1, descending=True)
+        class_score, class_idx = class_score[:, 1:], class_idx[:, 1:]
+
+        start = time.time()
+        for _ in range(args.iters):
+            attack_class = class_idx[:, 0].clone()
+            rand_seed = class_score.sum(dim=1) * torch.rand([attack_size], device=device)
+            prob = class_score.cumsum(dim=1)
+            for k in range(attack_size):
+                for c in range(prob.shape[1]):
+                    if (prob[k, c] >= rand_seed[k]).cpu().numpy():
+                        attack_class[k] = class_idx[k, c]
+                        break
+        t_loop = (time.time() - start) / args.iters
+
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(args.iters):
+            sample_attack_class(class_score, class_idx)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        t_vector = (time.time() - start) / args.iters
+        print('{:>12} {:>12.2f} {:>12.3f} {:>10.0f}x'.format(
+            attack_size, t_loop * 1000, t_vector * 1000, t_loop / t_vector))
+
+
+def bench_nst(args):
+    '''
+    Time and peak memory of one NST forward + backward on random rb3 sized feature
+    maps for each form of the kernel (see kd_losses/nst.py), and the deviation of the
+    loss from the original form. Peak memory is only reported on CUDA.
+    '''
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    hw = args.size * args.size
+    fm_s = torch.randn(args.batch_size, args.c_s, args.size, args.size, device=device)
+    fm_t = torch.randn(args.batch_size, args.c_t, args.size, args.size, device=device)
+
+    print('batch size: {}, student channels: {}, teacher channels: {}, HW: {}, device: {}'.format(
+        args.batch_size, args.c_s, args.c_t, hw, device))
+    print('{:>8} {:>9} {:>12} {:>10} {:>12}'.format('gram', 'channels', 'peak(MB)', 'ms/iter', 'loss err(%)'))
+    ref = None
+    for gram, channels in [('full', 0), ('channel', 0), ('spatial', 0)] + [('auto', c) for c in args.channels]:
+        criterion = NST(gram, channels)
+        fm = fm_s.clone().requires_grad_(True)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+        start = time.time()
+        for _ in range(args.iters):
+            loss = criterion(fm, fm_t)
+            loss.backward()
+        peak = '-'
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            peak = '{:.1f}'.format((torch.cuda.max_memory_allocated() - base) / 1e6)
+        t = (time.time() - start) / args.iters
+        if ref is None:
+            ref = loss.item()
+        err = abs(loss.item() - ref) / ref * 100
+        print('{:>8} {:>9} {:>12} {:>10.2f} {:>12.3f}'.format(gram, channels or 'all', peak, t * 1000, err))
+
+
+def rss_anon():
+    # private resident memory of this process in MB (Linux)
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) / 1024.0
+    return float('nan')
+
+
+def bench_teacher_load(args):
+    '''
+    Load time and private CPU memory of the teacher per job: torch.load of the
+    checkpoint into a new net against mapping the shared weights file
+    (teacher_weights.py). Without --t_model a random checkpoint is written to a
+    temporary directory first.
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        t_model = args.t_model
+        if not t_model:
+            t_model = os.path.join(tmp, 'teacher.pth.tar')
+            torch.save({'net': define_tsnet(args.t_name, args.num_class, cuda=False).state_dict()}, t_model)
+        root = args.shared or tmp
+        export_shared_weights(t_model, root)
+
+        def load_private():
+            net = define_tsnet(args.t_name, args.num_class, cuda=False, parallel=None)
+            load_pretrained_model(net, torch.load(t_model, map_location='cpu')['net'])
+            return net
+
+        def load_shared():
+            with torch.device('meta'):
+                net = define_tsnet(args.t_name, args.num_class, cuda=False, parallel=None)
+            load_shared_weights(net, t_model, root)
+            return net
+
+        print('teacher: {}, jobs: {}'.format(args.t_name, args.jobs))
+        print('{:>8} {:>12} {:>16}'.format('load', 'ms/job', 'private MB/job'))
+        for name, load in [('private', load_private), ('shared', load_shared)]:
+            base = rss_anon()
+            start = time.time()
+            nets = [load() for _ in range(args.jobs)]
+            t = (time.time() - start) / args.jobs
+            print('{:>8} {:>12.1f} {:>16.1f}'.format(name, t * 1000, (rss_anon() - base) / args.jobs))
+            del nets
+
+
+def main():
+    parser = argparse.ArgumentParser(description='micro-benchmarks')
+    subparsers = parser.add_subparsers(dest='bench')
+    subparsers.required = True
+
+    p = subparsers.add_parser('topk', help='top-k teacher logit store')
+    p.add_argument('--cache', type=str, default='', help='dense teacher cache dir, random logits if empty')
+    p.add_argument('--num', type=int, default=10000, help='number of teacher outputs to use')
+    p.add_argument('--num_class', type=int, default=100, help='number of classes for random logits')
+    p.add_argument('--T', type=float, default=4.0, help='temperature for ST')
+    p.add_argument('--noise', type=float, default=1.0, help='std of the noise between student and teacher logits')
+    p.add_argument('--k', type=int, nargs='+', default=[1, 2, 5, 10, 20, 50])
+    p.set_defaults(func=bench_topk)
+
+    p = subparsers.add_parser('augment', help='batch level CIFAR augmentation')
+    p.add_argument('--batch_size', type=int, default=128)
+    p.add_argument('--rotation', type=float, default=15.0, help='max rotation degree, 0 disables rotation')
+    p.add_argument('--iters', type=int, default=20)
+    p.set_defaults(func=bench_augment)
+
+    p = subparsers.add_parser('crd_sample', help='CRD negative sampling')
+    p.add_argument('--n_data', type=int, default=50000)
+    p.add_argument('--num_class', type=int, default=100)
+    p.add_argument('--nce_n', type=int, default=16384)
+    p.add_argument('--batch_size', type=int, default=64)
+    p.add_argument('--iters', type=int, default=5)
+    p.set_defaults(func=bench_crd_sample)
+
+    p = subparsers.add_parser('crd_memory', help='CRD memory bank storage and gather-score')
+    p.add_argument('--n_data', type=int, default=50000)
+    p.add_argument('--feat_dim', type=int, default=128)
+    p.add_argument('--nce_n', type=int, default=16384)
+    p.add_argument('--batch_size', type=int, default=64)
+    p.add_argument('--iters', type=int, default=5)
+    p.add_argument('--mem_dtype', type=str, nargs='+', default=['fp32', 'fp16', 'bf16'])
+    p.add_argument('--chunk', type=int, nargs='+', default=[0, 1024, 4096])
+    p.set_defaults(func=bench_crd_memory)
+
+    p = subparsers.add_parser('teacher', help='teacher forward memory per kd mode')
+    p.add_argument('--t_name', type=str, default='resnet101')
+    p.add_argument('--num_class', type=int, default=100)
+    p.add_argument('--batch_size', type=int, default=128)
+    p.set_defaults(func=bench_teacher)
+
+    p = subparsers.add_parser('bss_sample', help='BSS attack class sampling')
+    p.add_argument('--num_class', type=int, default=100)
+    p.add_argument('--attack_size', type=int, nargs='+', default=[32, 128])
+    p.add_argument('--iters', type=int, default=10)
+    p.set_defaults(func=bench_bss_sample)
+
+    p = subparsers.add_parser('nst', help='NST kernel forms')
+    p.add_argument('--batch_size', type=int, default=64)
+    p.add_argument('--c_s', type=int, default=256, help='student channels (resnet18 rb3)')
+    p.add_argument('--c_t', type=int, default=1024, help='teacher channels (resnet101 rb3)')
+    p.add_argument('--size', type=int, default=8, help='height and width of the feature maps')
+    p.add_argument('--channels', type=int, nargs='+', default=[128], help='sampled channels of the approximation')
+    p.add_argument('--iters', type=int, default=3)
+    p.set_defaults(func=bench_nst)
+
+    p = subparsers.add_parser('teacher_load', help='shared-memory teacher weights')
+    p.add_argument('--t_model', type=str, default='', help='teacher checkpoint, random weights if empty')
+    p.add_argument('--t_name', type=str, default='resnet101')
+    p.add_argument('--num_class', type=int, default=100)
+    p.add_argument('--shared', type=str, default='', help='dir of the shared weights file, a temporary dir if empty')
+    p.add_argument('--jobs', type=int, default=4, help='number of teachers loaded, as by that many jobs')
+    p.set_defaults(func=bench_teacher_load)
+
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
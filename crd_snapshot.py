@@ -0,0 +1,159 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+import os
+import json
+import queue
+import threading
+import numpy as np
+import torch
+
+'''
+Persistent copy of the CRD memory bank (ContrastMemory in kd_losses/crd.py).
+
+memory_s.npy and memory_t.npy are memory-mapped mirrors of the two buffers. Every
+momentum update hands its rows to a background thread that writes them into the
+files, so the training loop only pays for a device to host copy. The files are
+flushed every flush_every updates and on flush(); state.json is rewritten after each
+flush with Z_s/Z_t and the last epoch whose updates are all in the files.
+'''
+
+# numpy storage of the memory dtypes, bf16 is stored as its int16 bit pattern
+STORE_DTYPES = {torch.float32: np.float32, torch.float16: np.float16, torch.bfloat16: np.int16}
+
+
+def to_numpy(rows):
+    if rows.dtype == torch.bfloat16:
+        rows = rows.view(torch.int16)
+    return rows.numpy()
+
+
+def from_numpy(arr, dtype):
+    rows = torch.from_numpy(np.ascontiguousarray(arr))
+    if dtype == torch.bfloat16:
+        rows = rows.view(torch.bfloat16)
+    return rows
+
+
+class MemorySnapshot(object):
+    def __init__(self, root, flush_every=100):
+        self.root = root
+        self.flush_every = flush_every
+        self.contrast = None
+        self.arrays = {}
+        self.queue = queue.Queue()
+        self.thread = None
+        self.n_updates = 0
+        self.epoch = 0
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def exists(self):
+        return os.path.exists(self._path('state.json'))
+
+    def state(self):
+        with open(self._path('state.json')) as f:
+            return json.load(f)
+
+    def attach(self, contrast, resume=False):
+        '''
+        Mirrors contrast.memory_s/memory_t. With resume the buffers and Z_s/Z_t are
+        loaded from the snapshot, otherwise the current buffers are written out first.
+        Returns the epoch of the loaded snapshot, or 0.
+        '''
+        self.contrast = contrast
+        memory = contrast.memory_s
+        dtype = STORE_DTYPES[memory.dtype]
+        if resume:
+            if not self.exists():
+                raise Exception('No CRD memory snapshot in {}...'.format(self.root))
+            state = self.state()
+            for name in ('memory_s', 'memory_t'):
+                arr = np.load(self._path(name + '.npy'), mmap_mode='r+')
+                if arr.shape != tuple(memory.shape) or arr.dtype != dtype:
+                    raise Exception('CRD memory snapshot does not match the memory bank...')
+                getattr(contrast, name).copy_(from_numpy(arr, memory.dtype))
+                self.arrays[name] = arr
+            contrast.Z_s = state['Z_s']
+            contrast.Z_t = state['Z_t']
+            self.n_updates = state['n_updates']
+            self.epoch = state['epoch']
+        else:
+            for name in ('memory_s', 'memory_t'):
+                arr = np.lib.format.open_memmap(self._path(name + '.npy'), mode='w+', dtype=dtype,
+                                                shape=tuple(memory.shape))
+                arr[:] = to_numpy(getattr(contrast, name).cpu())
+                self.arrays[name] = arr
+            self._write()
+
+        contrast.on_update = self.push
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self.epoch
+
+    def push(self, idx, rows_s, rows_t):
+        # called from ContrastMemory.update, the copies to pinned host memory are
+        # asynchronous and the writer waits for them
+        event = None
+        if idx.is_cuda:
+            idx = self._pinned(idx)
+            rows_s = self._pinned(rows_s)
+            rows_t = self._pinned(rows_t)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            idx, rows_s, rows_t = idx.clone(), rows_s.clone(), rows_t.clone()
+        self.queue.put(('rows', event, idx, rows_s, rows_t))
+
+    def _pinned(self, x):
+        out = torch.empty(x.size(), dtype=x.dtype, pin_memory=True)
+        out.copy_(x, non_blocking=True)
+        return out
+
+    def flush(self, epoch, wait=False):
+        # flushes once every update pushed so far is written, then records epoch
+        done = threading.Event()
+        self.queue.put(('flush', epoch, done))
+        if wait:
+            done.wait()
+
+    def close(self, epoch):
+        if self.thread is not None:
+            self.flush(epoch, wait=True)
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.contrast.on_update = None
+
+    def _write(self):
+        for arr in self.arrays.values():
+            arr.flush()
+        state = {'epoch': self.epoch, 'n_updates': self.n_updates,
+                 'Z_s': self.contrast.Z_s, 'Z_t': self.contrast.Z_t}
+        tmp_path = self._path('state.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._path('state.json'))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if item[0] == 'flush':
+                _, self.epoch, done = item
+                self._write()
+                done.set()
+                continue
+            _, event, idx, rows_s, rows_t = item
+            if event is not None:
+                event.synchronize()
+            idx = idx.numpy()
+            self.arrays['memory_s'][idx] = to_numpy(rows_s)
+            self.arrays['memory_t'][idx] = to_numpy(rows_t)
+            self.n_updates += 1
+            if self.n_updates % self.flush_every == 0:
+                self._write()
@@ -5,15 +5,26 @@ import torchvision
 from torchvision import transforms
 from torch.utils.data import SubsetRandomSampler, DataLoader
 
+from dataUtils.augment import BatchAugment, BatchAugLoader
+from dataUtils.shared import SharedCIFAR, batch_collate
+
 
 # Get Data Loader
 def getDataLoader(root_path: str = '/home/lab265/lab265/datasets/', split_factor: float = 0.1, seed: int = 66,
-                  data_set: str = 'CIFAR10'):
+                  data_set: str = 'CIFAR10', batch_aug: bool = False, shared: bool = False, device=None,
+                  rank: int = 0, world_size: int = 1):
+    # batch_aug: augment whole uint8 batches in the main process (dataUtils/augment.py)
+    # instead of per-sample PIL transforms in 4 worker processes
+    # shared: keep the images in one shared-memory tensor (dataUtils/shared.py), the
+    # workers then fetch and augment whole batches from it
+    # rank/world_size: distributed training, every rank loads its shard of the train and
+    # validation splits with 128 / world_size samples per training batch
     data_set_path = os.path.join(root_path, data_set)
 
     if data_set == 'CIFAR10':
         print('=> loading cifar10 data...')
-        normalize = transforms.Normalize(mean=[0.4914, 0.4822, 0.4465], std=[0.2470, 0.2435, 0.2616])
+        mean, std, rotation = [0.4914, 0.4822, 0.4465], [0.2470, 0.2435, 0.2616], 0
+        normalize = transforms.Normalize(mean=mean, std=std)
 
         train_Transforms = transforms.Compose([
             transforms.RandomCrop(32, padding=4, padding_mode='reflect'),
@@ -27,16 +38,13 @@ def getDataLoader(root_path: str = '/home/lab265/lab265/datasets/', split_factor
             normalize
         ])
 
-        train_set = torchvision.datasets.CIFAR10(
-            root=data_set_path, train=True, download=True, transform=train_Transforms)
-
-        test_set = torchvision.datasets.CIFAR10(
-            root=data_set_path, train=False, download=True, transform=test_Transforms)
+        dataset = torchvision.datasets.CIFAR10
 
     elif data_set == 'CIFAR100':
 
         print('=> loading cifar100 data...')
-        normalize = transforms.Normalize(mean=[0.5071, 0.4865, 0.4409], std=[0.2673, 0.2564, 0.2762])
+        mean, std, rotation = [0.5071, 0.4865, 0.4409], [0.2673, 0.2564, 0.2762], 15
+        normalize = transforms.Normalize(mean=mean, std=std)
         train_Transforms = transforms.Compose([
             transforms.RandomCrop(32, padding=4, padding_mode='reflect'),
             transforms.RandomHorizontalFlip(),
@@ -50,11 +58,16 @@ def getDataLoader(root_path: str = '/home/lab265/lab265/datasets/', split_factor
             normalize
         ])
 
-        train_set = torchvision.datasets.CIFAR100(
-            root=data_set_path, train=True, download=True, transform=train_Transforms)
+        dataset = torchvision.datasets.CIFAR100
 
-        test_set = torchvision.datasets.CIFAR100(
-            root=data_set_path, train=False, download=True, transform=test_Transforms)
+    if shared:
+        train_set = SharedCIFAR(data_set_path, data_set, train=True,
+                                transform=BatchAugment(mean, std, padding=4, flip=True, rotation=rotation))
+        test_set = SharedCIFAR(data_set_path, data_set, train=False,
+                               transform=BatchAugment(mean, std, padding=0, flip=False))
+    else:
+        train_set = dataset(root=data_set_path, train=True, download=True, transform=train_Transforms)
+        test_set = dataset(root=data_set_path, train=False, download=True, transform=test_Transforms)
 
     dataset_size = len(train_set)
     indices = list(range(dataset_size))
@@ -62,15 +75,31 @@ def getDataLoader(root_path: str = '/home/lab265/lab265/datasets/', split_factor
     np.random.seed(seed)
     np.random.shuffle(indices)
     train_indices, val_indices = indices[split:], indices[:split]
+    # shards of the same length, so every rank runs the same number of iterations
+    train_indices = train_indices[rank:len(train_indices) - len(train_indices) % world_size:world_size]
+    val_indices = val_indices[rank::world_size]
+    batch_size = 128 // world_size
+
+    if batch_aug:
+        train_aug = BatchAugment(mean, std, padding=4, flip=True, rotation=rotation)
+        test_aug = BatchAugment(mean, std, padding=0, flip=False)
+        train_loader = BatchAugLoader(train_set.data, train_set.targets, train_aug, batch_size=batch_size,
+                                      indices=train_indices, device=device)
+        validation_loader = BatchAugLoader(train_set.data, train_set.targets, train_aug, batch_size=100,
+                                           indices=val_indices, device=device)
+        test_loader = BatchAugLoader(test_set.data, test_set.targets, test_aug, batch_size=100, device=device)
+        return train_loader, validation_loader, test_loader
 
     # Creating PT data samplers and loaders:
     train_sampler = SubsetRandomSampler(train_indices)
     valid_sampler = SubsetRandomSampler(val_indices)
 
-    train_loader = DataLoader(train_set, batch_size=128, sampler=train_sampler,
-                              num_workers=4, drop_last=False, pin_memory=True)
+    collate_fn = batch_collate if shared else None
+    train_loader = DataLoader(train_set, batch_size=batch_size, sampler=train_sampler,
+                              num_workers=4, drop_last=False, pin_memory=True, collate_fn=collate_fn)
     validation_loader = DataLoader(train_set, batch_size=100, sampler=valid_sampler,
                                    num_workers=4, drop_last=False,
-                                   pin_memory=True)
-    test_loader = DataLoader(test_set, batch_size=100, shuffle=True, num_workers=4, drop_last=False, pin_memory=True)
+                                   pin_memory=True, collate_fn=collate_fn)
+    test_loader = DataLoader(test_set, batch_size=100, shuffle=True, num_workers=4, drop_last=False, pin_memory=True,
+                             collate_fn=collate_fn)
     return train_loader, validation_loader, test_loader
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import torch
+import torchvision
+from torch.utils.data import Dataset
+
+'''
+CIFAR preloaded into one shared-memory file.
+Images (N x 32 x 32 x 3 uint8) followed by labels (N uint8) are written once to
+/dev/shm and mapped with torch.from_file(shared=True), so the main process, every
+DataLoader worker and every other job on the host read the same physical pages.
+'''
+
+CIFAR_SHAPE = (32, 32, 3)
+
+
+def batch_collate(batch):
+    # SharedCIFAR.__getitems__ already returns a collated batch
+    return batch
+
+
+class SharedCIFAR(Dataset):
+    '''
+    transform is a batch transform on (B, H, W, C) uint8 tensors such as
+    dataUtils.augment.BatchAugment; without it the raw uint8 images are returned.
+    Batched fetching goes through __getitems__, use batch_collate as the collate_fn of
+    the DataLoader.
+    '''
+
+    def __init__(self, root, data_name, train=True, transform=None, download=True, return_index=False,
+                 shm_dir='/dev/shm'):
+        data_name = data_name.upper()
+        if data_name not in ('CIFAR10', 'CIFAR100'):
+            raise Exception('Invalid dataset name...')
+        self.root = root
+        self.data_name = data_name
+        self.train = train
+        self.download = download
+        self.transform = transform
+        self.return_index = return_index
+        self.path = os.path.join(shm_dir, 'kdzoo_{}_{}.u8'.format(data_name.lower(), 'train' if train else 'test'))
+        self.data = None
+        self.targets = None
+        if not os.path.exists(self.path):
+            self._preload()
+        self._map()
+
+    def _preload(self):
+        dataset = getattr(torchvision.datasets, self.data_name)(root=self.root, train=self.train,
+                                                                download=self.download)
+        data = np.ascontiguousarray(dataset.data, dtype=np.uint8)
+        targets = np.asarray(dataset.targets, dtype=np.uint8)
+        # write to a private name and rename, so that concurrent jobs never map a half
+        # written file
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data.tobytes())
+            f.write(targets.tobytes())
+        os.replace(tmp_path, self.path)
+
+    def _map(self):
+        sample_bytes = int(np.prod(CIFAR_SHAPE)) + 1
+        nbytes = os.path.getsize(self.path)
+        if nbytes % sample_bytes != 0:
+            raise Exception('Corrupted shared dataset file {}...'.format(self.path))
+        n_data = nbytes // sample_bytes
+        storage = torch.from_file(self.path, shared=True, size=nbytes, dtype=torch.uint8)
+        self.data = storage[:n_data * (sample_bytes - 1)].view(n_data, *CIFAR_SHAPE)
+        # int64 labels as torchvision's, a private copy of N values
+        self.targets = storage[n_data * (sample_bytes - 1):].long()
+
+    def __getstate__(self):
+        # workers started with spawn map the file again instead of receiving a copy
+        state = self.__dict__.copy()
+        state['data'] = None
+        state['targets'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map()
+
+    def __len__(self):
+        return self.data.size(0)
+
+    def __getitems__(self, indices):
+        index = torch.as_tensor(indices, dtype=torch.long)
+        img = self.data[index]
+        if self.transform is not None:
+            img = self.transform(img)
+        target = self.targets[index]
+        if self.return_index:
+            return img, target, index
+        return img, target
+
+    def __getitem__(self, index):
+        batch = self.__getitems__([index])
+        return tuple(x[0] for x in batch)
@@ -4,14 +4,56 @@ from __future__ import division
 import os
 import numpy as np
 from PIL import Image
+import torch
 import torchvision.datasets as dst
+from torch.utils.data.dataloader import default_collate
+
+from kd_losses.crd import ClassIndex
 
 '''
 Modified from https://github.com/HobbitLong/RepDistiller/blob/master/dataset/cifar100.py
 dataset.py is specially using for crd (crd paper)
+
+The datasets return (img, target, index); positive and negative sample indices are
+drawn for a whole batch at once by CRDSampleCollate, used as the collate_fn.
 '''
 
 
+class CRDSampleCollate(object):
+    '''
+    Collates (img, target, index) samples, or an already collated batch, and appends
+    sample_idx of shape (bs, n + 1): the positive index followed by n negatives.
+    With 0 < percent < 1 the negatives come from a fixed random subset of the data.
+    '''
+    def __init__(self, labels, num_classes, n=4096, mode='exact', percent=1.0):
+        if mode not in ('exact', 'relax'):
+            raise NotImplementedError(mode)
+        self.n = n
+        self.mode = mode
+        self.pos_index = ClassIndex(labels, num_classes)
+        self.neg_index = self.pos_index
+        if 0 < percent < 1:
+            n_data = self.pos_index.size
+            subset = torch.randperm(n_data)[:int(n_data * percent)]
+            self.neg_index = ClassIndex(labels, num_classes, subset)
+
+    def __call__(self, batch):
+        if isinstance(batch, list):
+            batch = default_collate(batch)
+        img, target, index = batch
+        target = torch.as_tensor(target, dtype=torch.long)
+        index = torch.as_tensor(index, dtype=torch.long)
+
+        if self.mode == 'exact':
+            pos_idx = index.view(-1, 1)
+        else:
+            pos_idx = self.pos_index.sample_same(target, 1)
+        neg_idx = self.neg_index.sample_other(target, self.n)
+        sample_idx = torch.cat((pos_idx, neg_idx), dim=1)
+
+        return img, target, index, sample_idx
+
+
 class CIFAR10IdxSample(dst.CIFAR10):
     def __init__(self, root, train=True,
                  transform=None, target_transform=None,
@@ -20,32 +62,7 @@ class CIFAR10IdxSample(dst.CIFAR10):
                          transform=transform, target_transform=target_transform)
         self.n = n
         self.mode = mode
-
-        num_classes = 10
-        num_samples = len(self.data)
-        labels = self.targets
-
-        self.cls_positive = [[] for _ in range(num_classes)]
-        for i in range(num_samples):
-            self.cls_positive[labels[i]].append(i)
-
-        self.cls_negative = [[] for _ in range(num_classes)]
-        for i in range(num_classes):
-            for j in range(num_classes):
-                if j == i:
-                    continue
-                self.cls_negative[i].extend(self.cls_positive[j])
-
-        self.cls_positive = [np.asarray(self.cls_positive[i]) for i in range(num_classes)]
-        self.cls_negative = [np.asarray(self.cls_negative[i]) for i in range(num_classes)]
-
-        if 0 < percent < 1:
-            num = int(len(self.cls_negative[0]) * percent)
-            self.cls_negative = [np.random.permutation(self.cls_negative[i])[0:num]
-                                 for i in range(num_classes)]
-
-        self.cls_positive = np.asarray(self.cls_positive)
-        self.cls_negative = np.asarray(self.cls_negative)
+        self.collate = CRDSampleCollate(self.targets, 10, n=n, mode=mode, percent=percent)
 
     def __getitem__(self, index):
         img, target = self.data[index], self.targets[index]
@@ -57,17 +74,7 @@ class CIFAR10IdxSample(dst.CIFAR10):
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        if self.mode == 'exact':
-            pos_idx = index
-        elif self.mode == 'relax':
-            pos_idx = np.random.choice(self.cls_positive[target], 1)[0]
-        else:
-            raise NotImplementedError(self.mode)
-        replace = True if self.n > len(self.cls_negative[target]) else False
-        neg_idx = np.random.choice(self.cls_negative[target], self.n, replace=replace)
-        sample_idx = np.hstack((np.asarray([pos_idx]), neg_idx))
-
-        return img, target, index, sample_idx
+        return img, target, index
 
 
 class CIFAR100IdxSample(dst.CIFAR100):
@@ -78,32 +85,7 @@ class CIFAR100IdxSample(dst.CIFAR100):
                          transform=transform, target_transform=target_transform)
         self.n = n
         self.mode = mode
-
-        num_classes = 100
-        num_samples = len(self.data)
-        labels = self.targets
-
-        self.cls_positive = [[] for _ in range(num_classes)]
-        for i in range(num_samples):
-            self.cls_positive[labels[i]].append(i)
-
-        self.cls_negative = [[] for _ in range(num_classes)]
-        for i in range(num_classes):
-            for j in range(num_classes):
-                if j == i:
-                    continue
-                self.cls_negative[i].extend(self.cls_positive[j])
-
-        self.cls_positive = [np.asarray(self.cls_positive[i]) for i in range(num_classes)]
-        self.cls_negative = [np.asarray(self.cls_negative[i]) for i in range(num_classes)]
-
-        if 0 < percent < 1:
-            num = int(len(self.cls_negative[0]) * percent)
-            self.cls_negative = [np.random.permutation(self.cls_negative[i])[0:num]
-                                 for i in range(num_classes)]
-
-        self.cls_positive = np.asarray(self.cls_positive)
-        self.cls_negative = np.asarray(self.cls_negative)
+        self.collate = CRDSampleCollate(self.targets, 100, n=n, mode=mode, percent=percent)
 
     def __getitem__(self, index):
         img, target = self.data[index], self.targets[index]
@@ -115,14 +97,4 @@ class CIFAR100IdxSample(dst.CIFAR100):
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        if self.mode == 'exact':
-            pos_idx = index
-        elif self.mode == 'relax':
-            pos_idx = np.random.choice(self.cls_positive[target], 1)[0]
-        else:
-            raise NotImplementedError(self.mode)
-        replace = True if self.n > len(self.cls_negative[target]) else False
-        neg_idx = np.random.choice(self.cls_negative[target], self.n, replace=replace)
-        sample_idx = np.hstack((np.asarray([pos_idx]), neg_idx))
-
-        return img, target, index, sample_idx
+        return img, target, index
@@ -0,0 +1,760 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import time
+import logging
+import argparse
+import queue
+import threading
+import contextlib
+import numpy as np
+from collections import OrderedDict, namedtuple
+
+import torch
+import torch.nn as nn
+import torch.backends.cudnn as cudnn
+import torch.distributed as dist
+from torch.utils.data.distributed import DistributedSampler
+import torchvision.transforms as transforms
+import torchvision.datasets as dst
+
+from utils import AverageMeter, accuracy, define_tsnet
+from utils import load_pretrained_model, save_checkpoint
+from utils import create_exp_dir, count_parameters_in_MB
+from dataUtils.augment import BatchAugment, BatchAugLoader
+from dataUtils.shared import SharedCIFAR, batch_collate
+from models.feature_taps import forward_taps, tap_channels, tap_layers, unwrap
+from teacher_weights import load_shared_weights
+from kd_losses import *
+
+'''
+Shared training engine of the train_*.py scripts: argument parsing, logging, nets,
+data loaders, the epoch loop with metering and checkpointing, and the registry of the
+kd modes of train_kd.py.
+
+A trainer describes one iteration as step(batch, epoch) -> (loss, stats), where stats
+is an ordered dict of the values to meter (losses and prec@k); the engine does the
+rest. Every kd_losses class declares the network outputs it consumes in `taps`, only
+those are captured from the forward of the student and the teacher (see
+models/feature_taps.py).
+
+Started with torchrun (WORLD_SIZE > 1) every process trains a DistributedDataParallel
+replica of the trainable nets on its shard of the data and runs its own copy of the
+frozen teacher, e.g. on the cores of one host:
+    torchrun --nproc_per_node=4 train_kd.py ... --cuda 0
+--batch_size is the global batch size, it is split over the processes. Test metrics
+are summed over the processes, only rank 0 logs and saves checkpoints.
+'''
+
+DATASETS = {
+    'cifar10': (dst.CIFAR10, (0.4914, 0.4822, 0.4465), (0.2470, 0.2435, 0.2616)),
+    'cifar100': (dst.CIFAR100, (0.5071, 0.4865, 0.4409), (0.2673, 0.2564, 0.2762)),
+}
+
+
+def get_parser(description, teacher=True):
+    parser = argparse.ArgumentParser(description=description)
+
+    # various path
+    parser.add_argument('--save_root', type=str, default='./results', help='models and logs are saved here')
+    parser.add_argument('--img_root', type=str, default='./datasets', help='path name of image dataset')
+    if teacher:
+        parser.add_argument('--s_init', type=str, required=True, help='initial parameters of student model')
+        parser.add_argument('--t_model', type=str, required=True, help='path name of teacher model')
+        parser.add_argument('--t_shared', type=str, default='', help='dir (e.g. /dev/shm) of the shared read-only '
+                                                                     'teacher weights mapped by every job on the host')
+
+    # training hyper parameters
+    parser.add_argument('--print_freq', type=int, default=50, help='frequency of showing training results on console')
+    parser.add_argument('--epochs', type=int, default=200, help='number of total epochs to run')
+    parser.add_argument('--batch_size', type=int, default=128, help='The size of batch')
+    parser.add_argument('--lr', type=float, default=0.1, help='initial learning rate')
+    parser.add_argument('--momentum', type=float, default=0.9, help='momentum')
+    parser.add_argument('--weight_decay', type=float, default=1e-4, help='weight decay')
+    parser.add_argument('--num_class', type=int, default=10, help='number of classes')
+    parser.add_argument('--cuda', type=int, default=1)
+
+    # others
+    parser.add_argument('--seed', type=int, default=2, help='random seed')
+    parser.add_argument('--note', type=str, default='try', help='note for this run')
+    parser.add_argument('--batch_aug', type=int, default=0, help='augment whole uint8 batches instead of per-sample '
+                                                                     'transforms in worker processes')
+    parser.add_argument('--shared_data', type=int, default=0, help='preload the dataset into one shared-memory tensor '
+                                                                       'read by all workers and jobs')
+    parser.add_argument('--dist_backend', type=str, default='gloo', help='backend of torch.distributed when started '
+                                                                         'with torchrun, gloo or nccl')
+
+    # net and dataset choosen
+    parser.add_argument('--data_name', type=str, required=True, help='name of dataset')  # cifar10/cifar100
+    if teacher:
+        parser.add_argument('--t_name', type=str, required=True, help='name of teacher')
+        parser.add_argument('--s_name', type=str, required=True, help='name of student')
+
+    return parser
+
+
+def setup(args, unparsed):
+    init_distributed(args)
+    args.save_root = os.path.join(args.save_root, args.note)
+
+    # the other ranks only log warnings
+    log_format = '%(message)s'
+    if is_main():
+        create_exp_dir(args.save_root)
+        logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=log_format)
+        fh = logging.FileHandler(os.path.join(args.save_root, 'log.txt'))
+        fh.setFormatter(logging.Formatter(log_format))
+        logging.getLogger().addHandler(fh)
+    else:
+        logging.basicConfig(stream=sys.stdout, level=logging.WARNING,
+                            format='[rank {}] {}'.format(args.rank, log_format))
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.cuda:
+        torch.cuda.manual_seed(args.seed)
+        cudnn.enabled = True
+        cudnn.benchmark = True
+    logging.info("args = %s", args)
+    logging.info("unparsed_args = %s", unparsed)
+
+
+def load_net(title, name, num_class, cuda, path=None, frozen=False, shared=''):
+    # distributed: the trainable nets are DistributedDataParallel, the frozen teacher
+    # is a plain replica on every rank
+    parallel = 'dp'
+    if distributed():
+        parallel = None if frozen else 'ddp'
+    if frozen and path and shared:
+        # the weights are mapped from the shared file (see teacher_weights.py)
+        with torch.device('meta'):
+            net = define_tsnet(name=name, num_class=num_class, cuda=False, return_features=False, parallel=None)
+        shared_path = load_shared_weights(net, path, shared)
+        logging.info('%s weights mapped from %s', title, shared_path)
+        if cuda:
+            net = net.cuda()
+        if parallel == 'dp':
+            net = nn.DataParallel(net)
+    else:
+        net = define_tsnet(name=name, num_class=num_class, cuda=cuda, return_features=False, parallel=parallel)
+        if path:
+            checkpoint = torch.load(path)
+            load_pretrained_model(net, checkpoint['net'])
+    if frozen:
+        net.eval()
+        for param in net.parameters():
+            param.requires_grad = False
+    logging.info('%s: %s', title, net)
+    logging.info('%s param size = %fMB', title, count_parameters_in_MB(net))
+    return net
+
+
+def sgd(args, params, lr=None, nesterov=True):
+    return torch.optim.SGD(params,
+                           lr=args.lr if lr is None else lr,
+                           momentum=args.momentum,
+                           weight_decay=args.weight_decay,
+                           nesterov=nesterov)
+
+
+def set_lr(optimizers, lr, epoch):
+    logging.info('Epoch: {}  lr: {:.4f}'.format(epoch, lr))
+    for optimizer in optimizers:
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = lr
+
+
+def step_lr(args, optimizers, epoch, milestones=(100, 150), scale=0.1):
+    # lr of the 200 epoch schedule of the repo: x0.1 after 100 and after 150 epochs
+    lr = args.lr * scale ** sum(epoch > m for m in milestones)
+    set_lr(optimizers, lr, epoch)
+
+
+# ---------------------------------------------------------------- distributed
+
+def init_distributed(args):
+    # joins the process group of torchrun, sets args.rank and args.world_size
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.rank = int(os.environ.get('RANK', 0))
+    if args.world_size == 1:
+        return
+    if args.batch_size % args.world_size != 0:
+        raise Exception('batch_size must be divisible by the number of processes...')
+    if args.cuda:
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    dist.init_process_group(backend=args.dist_backend, init_method='env://')
+
+
+def distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if distributed() else 1
+
+
+def is_main():
+    return get_rank() == 0
+
+
+@contextlib.contextmanager
+def main_first():
+    # rank 0 runs the block first (e.g. downloads the dataset), then the others
+    if distributed() and not is_main():
+        dist.barrier()
+    yield
+    if distributed() and is_main():
+        dist.barrier()
+
+
+def ddp(module):
+    # DistributedDataParallel for a criterion/auxiliary module with trainable parameters
+    if isinstance(module, nn.ModuleList):
+        return nn.ModuleList([ddp(m) for m in module])
+    params = list(module.parameters())
+    if not distributed() or not any(p.requires_grad for p in params):
+        return module
+    device_ids = [torch.cuda.current_device()] if params[0].is_cuda else None
+    return nn.parallel.DistributedDataParallel(module, device_ids=device_ids, broadcast_buffers=False)
+
+
+def shard_indices(n, even=True):
+    # the samples of this rank; even shards keep the number of iterations the same
+    # on every rank, as the gradient all-reduce needs
+    world_size = get_world_size()
+    if even:
+        n -= n % world_size
+    return list(range(get_rank(), n, world_size))
+
+
+def train_sampler(args, dataset):
+    if not distributed():
+        return None
+    return DistributedSampler(dataset, shuffle=True, seed=args.seed)
+
+
+def test_sampler(dataset):
+    # every test sample is read exactly once over the ranks, the shards may differ by
+    # one sample and so the ranks by one batch: the forwards of the test run no
+    # collectives (buffers are broadcast at the end of the training epoch instead)
+    if not distributed():
+        return None
+    return shard_indices(len(dataset), even=False)
+
+
+def reduce_meters(meters):
+    # sums and counts of the meters over the ranks, the averages are then over the
+    # whole dataset as with one process
+    if not distributed() or not meters:
+        return meters
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+    totals = torch.tensor([[m.sum, m.count] for m in meters.values()], dtype=torch.float64, device=device)
+    dist.all_reduce(totals)
+    for meter, (total, count) in zip(meters.values(), totals.tolist()):
+        meter.sum, meter.count = total, count
+        meter.avg = total / count
+    return meters
+
+
+def broadcast_buffers(modules):
+    # the buffers (BatchNorm statistics) of rank 0 to every DistributedDataParallel
+    # module. The modules are built with broadcast_buffers=False, so that their
+    # forwards run no collective, and synchronized here after every training epoch;
+    # rank 0 ends up with the buffers of the default broadcast on every forward.
+    if not distributed():
+        return
+    for module in modules:
+        for m in module.modules():
+            if isinstance(m, nn.parallel.DistributedDataParallel):
+                for buf in m.module.buffers():
+                    dist.broadcast(buf, 0)
+
+
+def no_sync(modules):
+    # no gradient synchronization of the DistributedDataParallel modules, for
+    # forwards that are not followed by a backward of the parameters
+    stack = contextlib.ExitStack()
+    for module in modules:
+        for m in module.modules():
+            if isinstance(m, nn.parallel.DistributedDataParallel):
+                stack.enter_context(m.no_sync())
+    return stack
+
+
+# ---------------------------------------------------------------- data
+
+def get_dataset(args):
+    name = args.data_name.lower()
+    if name not in DATASETS:
+        raise Exception('Invalid dataset name...')
+    return DATASETS[name]
+
+
+def get_transforms(mean, std):
+    train_transform = transforms.Compose([
+        transforms.Pad(4, padding_mode='reflect'),
+        transforms.RandomCrop(32),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=mean, std=std)
+    ])
+    test_transform = transforms.Compose([
+        transforms.CenterCrop(32),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=mean, std=std)
+    ])
+    return train_transform, test_transform
+
+
+def raw_dataset(args, train, transform=None, return_index=False):
+    # uint8 images without per-sample transforms; transform is a batch transform
+    dataset, _, _ = get_dataset(args)
+    if args.shared_data:
+        return SharedCIFAR(args.img_root, args.data_name, train=train, transform=transform,
+                           return_index=return_index)
+    return dataset(root=args.img_root, train=train, download=True)
+
+
+def get_loaders(args, train_set=None, collate_fn=None, sampler=None):
+    '''
+    Train and test loaders of args.data_name, using per-sample transforms in worker
+    processes, --batch_aug or --shared_data. train_set (with its collate_fn/sampler)
+    replaces the default training set. When distributed every rank loads its shard
+    with batch_size / world_size samples per batch.
+    '''
+    dataset, mean, std = get_dataset(args)
+    train_transform, test_transform = get_transforms(mean, std)
+    device = 'cuda' if args.cuda else None
+    batch_size = args.batch_size // get_world_size()
+
+    if distributed():
+        if sampler is not None:
+            raise Exception('A custom sampler is not supported in distributed training...')
+        with main_first():
+            for train in (True, False):
+                dataset(root=args.img_root, train=train, download=True)
+
+    if train_set is not None:
+        sampler = sampler if sampler is not None else train_sampler(args, train_set)
+        train_loader = torch.utils.data.DataLoader(
+            train_set, batch_size=batch_size, shuffle=sampler is None, sampler=sampler,
+            num_workers=4, pin_memory=True, collate_fn=collate_fn)
+    elif args.batch_aug:
+        train_set = raw_dataset(args, train=True)
+        indices = shard_indices(len(train_set)) if distributed() else None
+        train_loader = BatchAugLoader(train_set.data, train_set.targets, BatchAugment(mean, std),
+                                      batch_size=batch_size, indices=indices, device=device)
+    elif args.shared_data:
+        train_set = raw_dataset(args, train=True, transform=BatchAugment(mean, std))
+        sampler = train_sampler(args, train_set)
+        train_loader = torch.utils.data.DataLoader(
+            train_set, batch_size=batch_size, shuffle=sampler is None, sampler=sampler,
+            num_workers=4, pin_memory=True, collate_fn=batch_collate)
+    else:
+        train_set = dataset(root=args.img_root,
+                            transform=train_transform,
+                            train=True,
+                            download=True)
+        sampler = train_sampler(args, train_set)
+        train_loader = torch.utils.data.DataLoader(
+            train_set, batch_size=batch_size, shuffle=sampler is None, sampler=sampler,
+            num_workers=4, pin_memory=True)
+
+    test_aug = BatchAugment(mean, std, padding=0, flip=False)
+    if args.batch_aug:
+        test_set = raw_dataset(args, train=False)
+        test_loader = BatchAugLoader(test_set.data, test_set.targets, test_aug, batch_size=batch_size,
+                                     shuffle=False, indices=test_sampler(test_set), device=device)
+    elif args.shared_data:
+        test_set = raw_dataset(args, train=False, transform=test_aug)
+        test_loader = torch.utils.data.DataLoader(
+            test_set, batch_size=batch_size, shuffle=False, sampler=test_sampler(test_set),
+            num_workers=4, pin_memory=True, collate_fn=batch_collate)
+    else:
+        test_set = dataset(root=args.img_root,
+                           transform=test_transform,
+                           train=False,
+                           download=True)
+        test_loader = torch.utils.data.DataLoader(
+            test_set, batch_size=batch_size, shuffle=False, sampler=test_sampler(test_set),
+            num_workers=4, pin_memory=True)
+
+    return train_loader, test_loader
+
+
+def to_device(batch, cuda):
+    if not cuda:
+        return batch
+    return [x.cuda(non_blocking=True) if torch.is_tensor(x) else x for x in batch]
+
+
+# ---------------------------------------------------------------- kd modes
+
+def get_taps(criterion):
+    if isinstance(criterion, nn.ModuleList):
+        criterion = criterion[0]
+    return list(unwrap(criterion).taps)
+
+
+def apply_each(criterion, s, t, taps, **kwargs):
+    # mean of the criterion over the taps
+    return sum(criterion(s[k], t[k]) for k in taps) / len(taps)
+
+
+def apply_modules(criterion, s, t, taps, **kwargs):
+    # one criterion module per tap
+    return sum(c(s[k], t[k]) for c, k in zip(criterion, taps)) / len(taps)
+
+
+def apply_flow(criterion, s, t, taps, **kwargs):
+    # FSP between consecutive taps
+    pairs = list(zip(taps[:-1], taps[1:]))
+    return sum(criterion(s[a], s[b], t[a], t[b]) for a, b in pairs) / len(pairs)
+
+
+def apply_list(criterion, s, t, taps, **kwargs):
+    return criterion([s[k] for k in taps], [t[k] for k in taps])
+
+
+def apply_sobolev(criterion, s, t, taps, img=None, target=None):
+    return criterion(s['out'], t['out'], img, target)
+
+
+def apply_lwm(criterion, s, t, taps, img=None, target=None):
+    return criterion(s['out'], s['rb2'], t['out'], t['rb2'], target)
+
+
+# kd_mode -> the kd_losses class (its taps and teacher_grad), build(args, s_channels,
+# t_channels) of the criterion and how it is applied to the student and teacher taps
+KDMode = namedtuple('KDMode', ['cls', 'build', 'apply'])
+KD_MODES = OrderedDict()
+
+
+def register_kd(name, cls, build, apply=apply_each):
+    KD_MODES[name] = KDMode(cls, build, apply)
+
+
+register_kd('logits', Logits, lambda args, ch_s, ch_t: Logits())
+register_kd('st', SoftTarget, lambda args, ch_s, ch_t: SoftTarget(args.T))
+register_kd('at', AT, lambda args, ch_s, ch_t: AT(args.p))
+register_kd('fitnet', Hint, lambda args, ch_s, ch_t: Hint())
+register_kd('nst', NST, lambda args, ch_s, ch_t: NST(args.nst_gram, args.nst_channels))
+register_kd('pkt', PKTCosSim, lambda args, ch_s, ch_t: PKTCosSim(args.pkt_block))
+register_kd('fsp', FSP, lambda args, ch_s, ch_t: FSP(), apply_flow)
+register_kd('rkd', RKD, lambda args, ch_s, ch_t: RKD(args.w_dist, args.w_angle, args.rkd_angle, args.rkd_budget,
+                                                     args.rkd_triplets))
+register_kd('ab', AB, lambda args, ch_s, ch_t: AB(args.m))
+register_kd('sp', SP, lambda args, ch_s, ch_t: SP())
+register_kd('sobolev', Sobolev, lambda args, ch_s, ch_t: Sobolev(), apply_sobolev)
+register_kd('cc', CC, lambda args, ch_s, ch_t: CC(args.gamma, args.P_order, args.cc_kernel))
+register_kd('lwm', LwM, lambda args, ch_s, ch_t: LwM(), apply_lwm)
+register_kd('irg', IRG, lambda args, ch_s, ch_t: IRG(args.w_irg_vert, args.w_irg_edge, args.w_irg_tran), apply_list)
+register_kd('vid', VID, lambda args, ch_s, ch_t: nn.ModuleList(
+    [VID(ch_s[k], int(args.sf * ch_t[k]), ch_t[k], args.init_var) for k in VID.taps]), apply_modules)
+register_kd('ofd', OFD, lambda args, ch_s, ch_t: nn.ModuleList(
+    [OFD(ch_s[k], ch_t[k]) for k in OFD.taps]), apply_modules)
+# t_channels is same with s_channels
+register_kd('afd', AFD, lambda args, ch_s, ch_t: nn.ModuleList(
+    [AFD(ch_t[k], args.att_f) for k in AFD.taps]), apply_modules)
+
+
+def teacher_grad(criterion):
+    # sobolev/lwm differentiate through the teacher
+    if isinstance(criterion, nn.ModuleList):
+        criterion = criterion[0]
+    return getattr(unwrap(criterion), 'teacher_grad', False)
+
+
+# ---------------------------------------------------------------- teacher
+
+class Teacher(object):
+    '''
+    Runs the frozen teacher for the taps of a kd loss. Unless the loss needs teacher
+    gradients (grad=True, sobolev/lwm) the forward runs under torch.inference_mode
+    and only the requested taps are copied out of it, every other activation of the
+    teacher is freed before the call returns.
+    '''
+
+    def __init__(self, tnet, taps, grad=False):
+        self.tnet = tnet
+        self.taps = list(taps)
+        self.grad = grad
+
+    def __call__(self, img):
+        if self.grad:
+            return forward_taps(self.tnet, img, self.taps)
+        with torch.inference_mode():
+            t = forward_taps(self.tnet, img, self.taps)
+        # inference tensors cannot be saved for backward by the loss, plain copies can
+        return {k: v.clone() for k, v in t.items()}
+
+    def memory(self, img):
+        '''
+        Peak and retained CUDA memory (MB) of one teacher forward that keeps every
+        output in the autograd context, as the trainers used to, against this
+        wrapper. Returns None when img is not on a CUDA device.
+        '''
+        if not img.is_cuda:
+            return None
+
+        def measure(fn):
+            torch.cuda.synchronize()
+            base = torch.cuda.memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+            out = fn()
+            torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_allocated() - base
+            kept = torch.cuda.memory_allocated() - base
+            del out
+            return peak / 1e6, kept / 1e6
+
+        all_taps = list(tap_layers(self.tnet))
+        return OrderedDict([('full', measure(lambda: forward_taps(self.tnet, img, all_taps))),
+                            ('taps', measure(lambda: self(img)))])
+
+
+def log_teacher_memory(teacher, img, title):
+    memory = teacher.memory(img)
+    if memory is None:
+        logging.info('Teacher memory is only measured on CUDA')
+        return
+    (full_peak, full_kept), (peak, kept) = memory['full'], memory['taps']
+    logging.info('Teacher memory ({}, {}): all outputs peak {:.1f}MB kept {:.1f}MB, '
+                 'taps {} peak {:.1f}MB kept {:.1f}MB, saved {:.1f}MB'.format(
+        title, 'autograd' if teacher.grad else 'inference mode', full_peak, full_kept,
+        ','.join(teacher.taps), peak, kept, full_peak - peak))
+
+
+class TeacherPrefetcher(object):
+    '''
+    Pipelined teacher: a background thread takes the batches of loader, runs teacher
+    on them with its own intra-op thread budget and keeps up to depth batches of
+    (img, target, teacher outputs) ready in a bounded queue, so that on a many-core
+    CPU the teacher forward of the next batches overlaps the student step of the
+    current one. torch.set_num_threads sets the OpenMP budget of the calling thread,
+    the training thread keeps the remaining cores.
+    '''
+
+    def __init__(self, loader, teacher, depth=2, threads=1, cuda=False):
+        self.loader = loader
+        self.teacher = teacher
+        self.depth = depth
+        self.threads = threads
+        self.cuda = cuda
+        self.sampler = getattr(loader, 'sampler', None)
+        self.teacher_time = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _run(self, out, stop):
+        torch.set_num_threads(self.threads)
+        try:
+            for batch in self.loader:
+                if stop.is_set():
+                    return
+                img, target = to_device(batch, self.cuda)[:2]
+                start = time.time()
+                t = self.teacher(img)
+                self.teacher_time += time.time() - start
+                out.put((img, target, t))
+            out.put(None)
+        except Exception as e:
+            out.put(e)
+
+    def __iter__(self):
+        self.teacher_time = 0.0
+        wait_time = 0.0
+        out = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._run, args=(out, stop), daemon=True)
+        epoch_start = time.time()
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                item = out.get()
+                wait_time += time.time() - start
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # unblock the teacher thread if the loop stopped early
+            stop.set()
+            while thread.is_alive():
+                try:
+                    out.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+        # teacher time that the training thread did not wait for was overlapped
+        hidden = max(self.teacher_time - wait_time, 0.0)
+        logging.info('Teacher pipeline: total {:.1f}s, teacher {:.1f}s, waited {:.1f}s, '
+                     'overlapped {:.1f}s ({:.0f}%)'.format(
+            time.time() - epoch_start, self.teacher_time, wait_time, hidden,
+            100.0 * hidden / max(self.teacher_time, 1e-8)))
+
+
+# ---------------------------------------------------------------- loops
+
+def update_meters(meters, stats, n):
+    for name, val in stats.items():
+        if name not in meters:
+            meters[name] = AverageMeter()
+        meters[name].update(val.item() if torch.is_tensor(val) else val, n)
+
+
+def format_meters(meters, avg_only=False):
+    out = []
+    for name, meter in meters.items():
+        fmt = '{:.2f}' if name.lower().startswith('prec') else '{:.4f}'
+        if avg_only:
+            out.append(('{}: ' + fmt).format(name, meter.avg))
+        else:
+            out.append(('{}:' + fmt + '(' + fmt + ')').format(name, meter.val, meter.avg))
+    return ', '.join(out) if avg_only else '  '.join(out)
+
+
+def cls_stats(stats, out, target, suffix=''):
+    prec1, prec5 = accuracy(out, target, topk=(1, 5))
+    stats['prec{}@1'.format(suffix)] = prec1
+    stats['prec{}@5'.format(suffix)] = prec5
+    return stats
+
+
+def student_test_step(snet, criterionCls):
+    # classification loss and accuracy of the student only
+    def step(batch, epoch):
+        img, target = batch[:2]
+        out_s = forward_taps(snet, img, ['out'])['out']
+        cls_loss = criterionCls(out_s, target)
+        return cls_loss, cls_stats(OrderedDict([('Cls', cls_loss)]), out_s, target)
+    return step
+
+
+def train_epoch(args, loader, step, optimizers, epoch, modules=()):
+    batch_time = AverageMeter()
+    data_time = AverageMeter()
+    meters = OrderedDict()
+
+    for m in modules:
+        m.train()
+    # a new shuffle of the shards every epoch
+    if isinstance(getattr(loader, 'sampler', None), DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+    end = time.time()
+    for i, batch in enumerate(loader, start=1):
+        data_time.update(time.time() - end)
+
+        batch = to_device(batch, args.cuda)
+        loss, stats = step(batch, epoch)
+
+        for optimizer in optimizers:
+            optimizer.zero_grad()
+        loss.backward()
+        for optimizer in optimizers:
+            optimizer.step()
+
+        update_meters(meters, stats, batch[0].size(0))
+        batch_time.update(time.time() - end)
+        end = time.time()
+
+        if i % args.print_freq == 0:
+            log_str = ('Epoch[{0}]:[{1:03}/{2:03}] '
+                       'Time:{batch_time.val:.4f} '
+                       'Data:{data_time.val:.4f}  '.format(
+                epoch, i, len(loader), batch_time=batch_time, data_time=data_time))
+            logging.info(log_str + format_meters(meters))
+
+    broadcast_buffers(modules)
+    return reduce_meters(meters)
+
+
+def test_epoch(args, loader, step, modules=(), grad=False):
+    meters = OrderedDict()
+
+    for m in modules:
+        m.eval()
+
+    with no_sync(modules):
+        for i, batch in enumerate(loader, start=1):
+            batch = to_device(batch, args.cuda)
+            # sobolev/lwm need input gradients also at test time
+            with torch.set_grad_enabled(grad):
+                _, stats = step(batch, None)
+            update_meters(meters, stats, batch[0].size(0))
+
+    reduce_meters(meters)
+    logging.info(format_meters(meters, avg_only=True))
+    return meters
+
+
+def run_stage(args, loader, step, optimizers, epochs, adjust_lr=None, modules=()):
+    # extra training stage before the main loop (student init, paraphraser)
+    for epoch in range(1, epochs + 1):
+        if adjust_lr is not None:
+            adjust_lr(epoch)
+        epoch_start_time = time.time()
+        train_epoch(args, loader, step, optimizers, epoch, modules)
+        epoch_duration = time.time() - epoch_start_time
+        logging.info('Epoch time: {}s'.format(int(epoch_duration)))
+
+
+def top_prec(meters):
+    return meters['prec@1'].avg, meters['prec@5'].avg
+
+
+def fit(args, train_loader, test_loader, train_step, test_step, optimizers, checkpoint,
+        modules=(), adjust_lr=None, scheduler=None, score=top_prec, test_grad=False,
+        start_epoch=1, best=(0, 0), on_epoch_end=None):
+    '''
+    The epoch loop: lr schedule, train, test, checkpoint. checkpoint(epoch, meters,
+    best) returns the state to save, score(meters) the (prec@1, prec@5) that selects
+    the best model. on_epoch_end(epoch) runs before the checkpoint is written.
+    '''
+    best_top1, best_top5 = best
+    for epoch in range(start_epoch, args.epochs + 1):
+        if adjust_lr is not None:
+            adjust_lr(epoch)
+        else:
+            logging.info('Epoch: {}  lr: {:.4f}'.format(epoch, optimizers[0].param_groups[0]['lr']))
+
+        # train one epoch
+        epoch_start_time = time.time()
+        train_epoch(args, train_loader, train_step, optimizers, epoch, modules)
+
+        # evaluate on testing set
+        logging.info('Testing the models......')
+        meters = test_epoch(args, test_loader, test_step, modules, test_grad)
+        test_top1, test_top5 = score(meters)
+
+        epoch_duration = time.time() - epoch_start_time
+        logging.info('Epoch time: {}s'.format(int(epoch_duration)))
+
+        if scheduler is not None:
+            scheduler.step()
+        if on_epoch_end is not None:
+            on_epoch_end(epoch)
+
+        # save model
+        is_best = False
+        if test_top1 > best_top1:
+            best_top1 = test_top1
+            best_top5 = test_top5
+            is_best = True
+        if is_main():
+            logging.info('Saving models......')
+            state = checkpoint(epoch, meters, (best_top1, best_top5))
+            save_checkpoint(state, is_best, args.save_root)
+
+    return best_top1, best_top5
@@ -302,3 +302,51 @@ CUDA_VISIBLE_DEVICES=0 python -u train_dml.py \
 
 
 
+
+# SoftTarget on the CPU cores of one host, 4 processes with DistributedDataParallel over gloo
+# (add --nnodes/--node_rank/--master_addr to run on several hosts, --batch_size is the global batch size)
+torchrun --nproc_per_node=4 train_kd.py \
+                           --save_root "./results/st/" \
+                           --t_model "./results/base/base-c10-r110/model_best.pth.tar" \
+                           --s_init "./results/base/base-c10-r20/initial_r20.pth.tar" \
+                           --data_name cifar10 \
+                           --num_class 10 \
+                           --t_name resnet110 \
+                           --s_name resnet20 \
+                           --kd_mode st \
+                           --lambda_kd 0.1 \
+                           --T 4.0 \
+                           --cuda 0 \
+                           --note st-c10-r110-r20-ddp4
+
+# DML with a cohort of four nets, the three resnet20 run as one vectorized forward
+CUDA_VISIBLE_DEVICES=0 python -u train_dml.py \
+                           --save_root "./results/dml/" \
+                           --net_names resnet110 resnet20 resnet20 resnet20 \
+                           --net_inits "./results/base/base-c10-r110/initial_r110.pth.tar" \
+                                       "./results/base/base-c10-r20/initial_r20.pth.tar" \
+                                       "./results/base/base-c10-r20/initial_r20.pth.tar" \
+                                       "./results/base/base-c10-r20/initial_r20.pth.tar" \
+                           --data_name cifar10 \
+                           --num_class 10 \
+                           --lambda_kd 1.0 \
+                           --note dml4-c10-r110-r20
+
+# SoftTarget from a top-k teacher logit cache: student accuracy against the size of the cache
+# (k = 0 caches dense logits), compare prec@1 in the logs of the notes
+for k in 0 5 10 20; do
+CUDA_VISIBLE_DEVICES=0 python -u train_kd.py \
+                           --save_root "./results/st_topk/" \
+                           --t_model "./results/base/base-c100-r110/model_best.pth.tar" \
+                           --s_init "./results/base/base-c100-r20/initial_r20.pth.tar" \
+                           --data_name cifar100 \
+                           --num_class 100 \
+                           --t_name resnet110 \
+                           --s_name resnet20 \
+                           --kd_mode st \
+                           --lambda_kd 0.1 \
+                           --T 4.0 \
+                           --teacher_cache "./results/st_topk/cache-c100-r110-k${k}/" \
+                           --cache_topk ${k} \
+                           --note st-c100-r110-r20-top${k}
+done
@@ -1,18 +1,17 @@
 from .logits import Logits
-from .st import SoftTarget
+from .st import SoftTarget, SparseSoftTarget
 from .at import AT
 from .fitnet import Hint
 from .nst import NST
 from .pkt import PKTCosSim
 from .fsp import FSP
 from .ft import FT
-from .dml import DML
-from .kdsvd import KDSVD
+from .dml import DML, CohortDML
 from .rkd import RKD
 from .ab import AB
 from .sp import SP
 from .sobolev import Sobolev
-from .bss import BSS, BSSAttacker
+from .bss import BSS, BSSAttacker, sample_attack_class
 from .cc import CC
 from .lwm import LwM
 from .irg import IRG
@@ -11,6 +11,8 @@ class AB(nn.Module):
 	Knowledge Transfer via Distillation of Activation Boundaries Formed by Hidden Neurons
 	https://arxiv.org/pdf/1811.03233.pdf
 	'''
+	taps = ['rb1_pre', 'rb2_pre', 'rb3_pre']
+
 	def __init__(self, margin):
 		super(AB, self).__init__()
 
@@ -19,6 +19,8 @@ class AFD(nn.Module):
 	Pay Attention to Features, Transfer Learn Faster CNNs
 	https://openreview.net/pdf?id=ryxyCeHtPB
 	'''
+	taps = ['rb1', 'rb2', 'rb3']
+
 	def __init__(self, in_channels, att_f):
 		super(AFD, self).__init__()
 		mid_channels = int(in_channels * att_f)
@@ -15,6 +15,8 @@ class AT(nn.Module):
 	Neural Netkworks wia Attention Transfer
 	https://arxiv.org/pdf/1612.03928.pdf
 	'''
+	taps = ['rb1', 'rb2', 'rb3']
+
 	def __init__(self, p):
 		super(AT, self).__init__()
 		self.p = p
@@ -4,7 +4,6 @@ from __future__ import division
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd.gradcheck import zero_gradients
 '''
 Modified by https://github.com/bhheo/BSS_distillation
 '''
@@ -20,11 +19,25 @@ def l2_norm(x, keepdim=True):
 	return norm.sqrt()
 
 
+def sample_attack_class(class_score, class_idx):
+	'''
+	One attack class per row, drawn with probability proportional to class_score
+	(teacher scores of the candidate classes class_idx) by inverse CDF: the first
+	class whose cumulative score reaches a uniform draw in [0, total score).
+	'''
+	prob = class_score.cumsum(dim=1)
+	rand_seed = prob[:, -1:] * torch.rand_like(prob[:, -1:])
+	pos = torch.searchsorted(prob, rand_seed).clamp_(max=prob.size(1) - 1)
+	return class_idx.gather(1, pos).squeeze(1)
+
+
 class BSS(nn.Module):
 	'''
 	Knowledge Distillation with Adversarial Samples Supporting Decision Boundary
 	https://arxiv.org/pdf/1805.05532.pdf
 	'''
+	taps = ['out']
+
 	def __init__(self, T):
 		super(BSS, self).__init__()
 		self.T = T
@@ -38,38 +51,44 @@ class BSS(nn.Module):
 
 
 class BSSAttacker():
+	'''
+	Moves each sample towards its attack class until the model no longer predicts its
+	target or num_steps is reached. A sample that flipped is never updated again, so
+	it is dropped from the batch: every step only runs the model on the samples that
+	are still predicted as their target, and the input gradients are taken with
+	torch.autograd.grad.
+	'''
 	def __init__(self, step_alpha, num_steps, eps=1e-4):
 		self.step_alpha = step_alpha
 		self.num_steps = num_steps
 		self.eps = eps
 
 	def attack(self, model, img, target, attack_class):
-		img = img.detach().requires_grad_(True)
-
-		step = 0
-		while step < self.num_steps:
-			zero_gradients(img)
-			_, _, _, _, _, output = model(img)
+		img = img.detach().clone()
+		active = torch.arange(img.size(0), device=img.device)
+
+		for step in range(self.num_steps):
+			x = img[active].requires_grad_(True)
+			output = model(x)
+			if isinstance(output, tuple):
+				output = output[-1]
+
+			# only the samples still predicted as their target are moved
+			keep = target[active] == output.max(1)[1]
+			if not keep.any():
+				break
 
 			score = F.softmax(output, dim=1)
-			score_target = score.gather(1, target.unsqueeze(1))
-			score_attack_class = score.gather(1, attack_class.unsqueeze(1))
-
-			loss = (score_attack_class - score_target).sum()
-			loss.backward()
-
-			step_alpha = self.step_alpha * (target == output.max(1)[1]).float()
-			step_alpha = step_alpha.unsqueeze(1).unsqueeze(1).unsqueeze(1)
-			if step_alpha.sum() == 0:
-				break
+			score_target = score.gather(1, target[active].unsqueeze(1))
+			score_attack_class = score.gather(1, attack_class[active].unsqueeze(1))
 
-			pert = (score_target - score_attack_class).unsqueeze(1).unsqueeze(1)
-			norm_pert = step_alpha * (pert + self.eps) * img.grad / l2_norm(img.grad)
+			loss = (score_attack_class - score_target)[keep].sum()
+			grad = torch.autograd.grad(loss, x)[0][keep]
 
-			step_adv = img + norm_pert
-			step_adv = torch.clamp(step_adv, -2.5, 2.5)
-			img.data = step_adv.data
+			pert = (score_target - score_attack_class)[keep].detach().unsqueeze(1).unsqueeze(1)
+			norm_pert = self.step_alpha * (pert + self.eps) * grad / l2_norm(grad)
 
-			step += 1
+			active = active[keep]
+			img[active] = torch.clamp(x.detach()[keep] + norm_pert, -2.5, 2.5)
 
 		return img
@@ -6,6 +6,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import math
 
+from .relations import cos_sim, triu
+
 
 '''
 CC with P-order Taylor Expansion of Gaussian RBF kernel
@@ -15,27 +17,70 @@ class CC(nn.Module):
 	Correlation Congruence for Knowledge Distillation
 	http://openaccess.thecvf.com/content_ICCV_2019/papers/
 	Peng_Correlation_Congruence_for_Knowledge_Distillation_ICCV_2019_paper.pdf
+
+	kernel 'taylor' is the P-order Taylor expansion of the paper, evaluated with
+	Horner's scheme, 'exact' the Gaussian RBF exp(-2*gamma*(1-s)) itself. The
+	correlation matrices are symmetric, with sym only their upper triangle and
+	diagonal are computed.
 	'''
-	def __init__(self, gamma, P_order):
+	taps = ['feat']
+
+	def __init__(self, gamma, P_order, kernel='taylor', sym=True):
 		super(CC, self).__init__()
+		if kernel not in ('taylor', 'exact'):
+			raise Exception('Invalid CC kernel {}...'.format(kernel))
 		self.gamma = gamma
 		self.P_order = P_order
+		self.kernel = kernel
+		self.sym = sym
+		self.coeffs = [math.exp(-2*gamma) * (2*gamma)**p / math.factorial(p) for p in range(P_order+1)]
 
 	def forward(self, feat_s, feat_t):
-		corr_mat_s = self.get_correlation_matrix(feat_s)
-		corr_mat_t = self.get_correlation_matrix(feat_t)
+		if not self.sym:
+			corr_mat_s = self.get_correlation_matrix(feat_s)
+			corr_mat_t = self.get_correlation_matrix(feat_t)
+			return F.mse_loss(corr_mat_s, corr_mat_t)
 
-		loss = F.mse_loss(corr_mat_s, corr_mat_t)
+		# mse over the full matrices: the strict upper triangle counts twice
+		sim_s, sim_t = cos_sim(feat_s), cos_sim(feat_t)
+		n = sim_s.size(0)
+		loss_triu = F.mse_loss(self.correlation(triu(sim_s)), self.correlation(triu(sim_t)), reduction='sum')
+		loss_diag = F.mse_loss(self.correlation(sim_s.diagonal()), self.correlation(sim_t.diagonal()), reduction='sum')
 
-		return loss
+		return (2.0 * loss_triu + loss_diag) / (n * n)
 
 	def get_correlation_matrix(self, feat):
-		feat = F.normalize(feat, p=2, dim=-1)
-		sim_mat  = torch.matmul(feat, feat.t())
-		corr_mat = torch.zeros_like(sim_mat)
+		return self.correlation(cos_sim(feat))
+
+	def correlation(self, sim):
+		# kernel of the cosine similarities, sim is shared and left untouched
+		if self.kernel == 'exact':
+			return torch.exp(sim.sub(1).mul_(2*self.gamma))
+		return TaylorRBF.apply(sim, self.coeffs)
+
+
+class TaylorRBF(torch.autograd.Function):
+	'''
+	sum_p coeffs[p] * sim^p by Horner's scheme in place on a single buffer. Only sim
+	is saved for backward, the derivative polynomial is evaluated the same way.
+	'''
+	@staticmethod
+	def forward(ctx, sim, coeffs):
+		ctx.save_for_backward(sim)
+		ctx.coeffs = coeffs
+		return horner(sim, coeffs)
+
+	@staticmethod
+	def backward(ctx, grad_output):
+		sim, = ctx.saved_tensors
+		dcoeffs = [p * c for p, c in enumerate(ctx.coeffs)][1:]
+		if not dcoeffs:
+			return torch.zeros_like(sim), None
+		return horner(sim, dcoeffs).mul_(grad_output), None
 
-		for p in range(self.P_order+1):
-			corr_mat += math.exp(-2*self.gamma) * (2*self.gamma)**p / \
-						math.factorial(p) * torch.pow(sim_mat, p)
 
-		return corr_mat
+def horner(x, coeffs):
+	out = torch.full_like(x, coeffs[-1])
+	for c in reversed(coeffs[:-1]):
+		out.mul_(x).add_(c)
+	return out
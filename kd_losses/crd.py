@@ -27,19 +27,28 @@ class CRD(nn.Module):
 		nce_t: the temperature
 		nce_mom: the momentum for updating the memory buffer
 		n_data: the number of samples in the training set, which is the M in Eq.(19)
+		labels: the labels of the training set; if given, the negatives can be drawn on
+		        the device of the memory from the target of each sample instead of
+		        passing sample_idx
+		mode: 'exact' or 'relax', how the positive is chosen when drawing on device
+		mem_dtype: 'fp32', 'fp16' or 'bf16', storage type of the memory buffer
+		chunk: if > 0, chunk size of the fused gather-score over the N+1 samples
 	'''
-	def __init__(self, s_dim, t_dim, feat_dim, nce_n, nce_t, nce_mom, n_data):
+	taps = ['feat']
+
+	def __init__(self, s_dim, t_dim, feat_dim, nce_n, nce_t, nce_mom, n_data, labels=None, mode='exact',
+				 mem_dtype='fp32', chunk=0):
 		super(CRD, self).__init__()
 		self.embed_s = Embed(s_dim, feat_dim)
 		self.embed_t = Embed(t_dim, feat_dim)
-		self.contrast = ContrastMemory(feat_dim, n_data, nce_n, nce_t, nce_mom)
+		self.contrast = ContrastMemory(feat_dim, n_data, nce_n, nce_t, nce_mom, labels, mode, mem_dtype, chunk)
 		self.criterion_s = ContrastLoss(n_data)
 		self.criterion_t = ContrastLoss(n_data)
 
-	def forward(self, feat_s, feat_t, idx, sample_idx):
+	def forward(self, feat_s, feat_t, idx, sample_idx=None, target=None):
 		feat_s = self.embed_s(feat_s)
 		feat_t = self.embed_t(feat_t)
-		out_s, out_t = self.contrast(feat_s, feat_t, idx, sample_idx)
+		out_s, out_t = self.contrast(feat_s, feat_t, idx, sample_idx, target)
 		loss_s = self.criterion_s(out_s)
 		loss_t = self.criterion_t(out_t)
 		loss = loss_s + loss_t
@@ -87,35 +96,188 @@ class ContrastLoss(nn.Module):
 		return loss
 
 
+class ClassIndex(object):
+	'''
+	Compact class index: the sample indices sorted by class (order) and the range
+	[start[c], start[c] + count[c]) of every class c in order. Samples are drawn on
+	the device of the index, see to().
+	'''
+	def __init__(self, labels, num_classes, subset=None):
+		labels = torch.as_tensor(labels, dtype=torch.long)
+		index = torch.arange(labels.numel()) if subset is None else torch.as_tensor(subset, dtype=torch.long)
+		labels = labels[index]
+		self.order = index[torch.argsort(labels, stable=True)]
+		self.count = torch.bincount(labels, minlength=num_classes)
+		self.start = torch.cumsum(self.count, 0) - self.count
+		self.size = index.numel()
+
+	def to(self, device):
+		# moves the index in place, returns self
+		self.order = self.order.to(device)
+		self.count = self.count.to(device)
+		self.start = self.start.to(device)
+		return self
+
+	def sample_same(self, target, n):
+		# n samples of the own class of each target, with replacement
+		r = (torch.rand(target.numel(), n, device=self.count.device) * self.count[target].unsqueeze(1)).long()
+		return self.order[self.start[target].unsqueeze(1) + r]
+
+	def sample_other(self, target, n):
+		# n samples of all but the own class of each target, with replacement: draw an
+		# offset among the size - count[c] other samples and jump over the block of c
+		count = self.count[target].unsqueeze(1)
+		start = self.start[target].unsqueeze(1)
+		r = (torch.rand(target.numel(), n, device=count.device) * (self.size - count)).long()
+		r = r + (r >= start).long() * count
+		return self.order[r]
+
+
+MEM_DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+class GatherScore(torch.autograd.Function):
+	'''
+	out[b, j] = exp(<memory[sample_idx[b, j]], feat[b]> / T), computed in chunks of
+	the N+1 dimension, so only bs x chunk x feat_dim rows of the memory are gathered
+	at a time, in forward and again in backward. The products run in the dtype of the
+	memory. The memory gets no gradient and must not be modified between forward and
+	backward.
+	'''
+	@staticmethod
+	def forward(ctx, feat, memory, sample_idx, T, chunk):
+		bs, feat_dim = feat.size()
+		out = feat.new_empty(sample_idx.size())
+		feat_mem = feat.to(memory.dtype)
+		for j in range(0, sample_idx.size(1), chunk):
+			idx = sample_idx[:, j:j + chunk]
+			weight = torch.index_select(memory, 0, idx.reshape(-1)).view(bs, -1, feat_dim)
+			out[:, j:j + chunk] = torch.bmm(weight, feat_mem.unsqueeze(2)).squeeze(2)
+		out.div_(T).exp_()
+		ctx.save_for_backward(feat, memory, sample_idx, out)
+		ctx.T = T
+		ctx.chunk = chunk
+
+		return out
+
+	@staticmethod
+	def backward(ctx, grad_out):
+		feat, memory, sample_idx, out = ctx.saved_tensors
+		bs, feat_dim = feat.size()
+		grad = (grad_out * out / ctx.T).to(memory.dtype)
+		grad_feat = torch.zeros_like(feat)
+		for j in range(0, sample_idx.size(1), ctx.chunk):
+			idx = sample_idx[:, j:j + ctx.chunk]
+			weight = torch.index_select(memory, 0, idx.reshape(-1)).view(bs, -1, feat_dim)
+			grad_feat += torch.bmm(grad[:, j:j + ctx.chunk].unsqueeze(1), weight).squeeze(1)
+
+		return grad_feat, None, None, None, None
+
+
 class ContrastMemory(nn.Module):
-	def __init__(self, feat_dim, n_data, nce_n, nce_t, nce_mom):
+	'''
+	memory buffers of the student and teacher embeddings
+
+	sample_idx (bs x (N+1), positive first) is either given or, when the labels of the
+	training set are known, drawn here from a ClassIndex kept on the device of the
+	memory.
+
+	mem_dtype: 'fp32', 'fp16' or 'bf16', storage type of the memory buffers
+	chunk: if > 0, score with GatherScore in chunks of the N+1 dimension instead of
+	       gathering bs x (N+1) x feat_dim weights; the momentum update of the memory
+	       is then applied at the beginning of the next forward (or by flush()) so that
+	       backward sees the same memory as forward
+	on_update: optional callback(idx, rows_s, rows_t) receiving the rows written by
+	           every momentum update, e.g. crd_snapshot.MemorySnapshot
+	'''
+	def __init__(self, feat_dim, n_data, nce_n, nce_t, nce_mom, labels=None, mode='exact',
+				 mem_dtype='fp32', chunk=0):
 		super(ContrastMemory, self).__init__()
 		self.N = nce_n
 		self.T = nce_t
 		self.momentum = nce_mom
+		self.mode = mode
+		self.chunk = chunk
 		self.Z_t = None
 		self.Z_s = None
+		self.pending = None
+		self.on_update = None
 
 		stdv = 1. / math.sqrt(feat_dim / 3.)
-		self.register_buffer('memory_t', torch.rand(n_data, feat_dim).mul_(2 * stdv).add_(-stdv))
-		self.register_buffer('memory_s', torch.rand(n_data, feat_dim).mul_(2 * stdv).add_(-stdv))
+		dtype = MEM_DTYPES[mem_dtype]
+		self.register_buffer('memory_t', torch.rand(n_data, feat_dim).mul_(2 * stdv).add_(-stdv).to(dtype))
+		self.register_buffer('memory_s', torch.rand(n_data, feat_dim).mul_(2 * stdv).add_(-stdv).to(dtype))
+
+		self.class_index = None
+		if labels is not None:
+			labels = torch.as_tensor(labels, dtype=torch.long)
+			self.class_index = ClassIndex(labels, int(labels.max()) + 1)
+
+	def sample(self, idx, target):
+		if self.class_index is None:
+			raise Exception('ContrastMemory needs the labels of the training set to draw negatives...')
+		# follow the memory when the module was moved
+		class_index = self.class_index.to(self.memory_s.device)
 
-	def forward(self, feat_s, feat_t, idx, sample_idx):
+		if self.mode == 'exact':
+			pos_idx = idx.view(-1, 1)
+		elif self.mode == 'relax':
+			pos_idx = class_index.sample_same(target, 1)
+		else:
+			raise NotImplementedError(self.mode)
+		neg_idx = class_index.sample_other(target, self.N)
+
+		return torch.cat((pos_idx, neg_idx), dim=1)
+
+	def update(self, idx, feat_s, feat_t):
+		with torch.no_grad():
+			pos_mem_t = torch.index_select(self.memory_t, 0, idx.view(-1)).float()
+			pos_mem_t.mul_(self.momentum)
+			pos_mem_t.add_(torch.mul(feat_t, 1 - self.momentum))
+			pos_mem_t = F.normalize(pos_mem_t, p=2, dim=1).to(self.memory_t.dtype)
+			self.memory_t.index_copy_(0, idx, pos_mem_t)
+
+			pos_mem_s = torch.index_select(self.memory_s, 0, idx.view(-1)).float()
+			pos_mem_s.mul_(self.momentum)
+			pos_mem_s.add_(torch.mul(feat_s, 1 - self.momentum))
+			pos_mem_s = F.normalize(pos_mem_s, p=2, dim=1).to(self.memory_s.dtype)
+			self.memory_s.index_copy_(0, idx, pos_mem_s)
+
+			if self.on_update is not None:
+				self.on_update(idx, pos_mem_s, pos_mem_t)
+
+	def flush(self):
+		# apply a deferred memory update, call after the last backward before reading the memory
+		if self.pending is not None:
+			self.update(*self.pending)
+			self.pending = None
+
+	def forward(self, feat_s, feat_t, idx, sample_idx=None, target=None):
 		bs = feat_s.size(0)
 		feat_dim = self.memory_s.size(1)
 		n_data = self.memory_s.size(0)
 
-		# using teacher as anchor
-		weight_s = torch.index_select(self.memory_s, 0, sample_idx.view(-1)).detach()
-		weight_s = weight_s.view(bs, self.N + 1, feat_dim)
-		out_t = torch.bmm(weight_s, feat_t.view(bs, feat_dim, 1))
-		out_t = torch.exp(torch.div(out_t, self.T)).squeeze().contiguous()
+		self.flush()
+		if sample_idx is None:
+			sample_idx = self.sample(idx, target)
+
+		if self.chunk > 0:
+			out_t = GatherScore.apply(feat_t, self.memory_s, sample_idx, self.T, self.chunk)
+			out_s = GatherScore.apply(feat_s, self.memory_t, sample_idx, self.T, self.chunk)
+		else:
+			# the gathered rows stay in the dtype of the memory, the features are cast to
+			# it instead, so no fp32 copy of the rows is made or kept for backward
+			# using teacher as anchor
+			weight_s = torch.index_select(self.memory_s, 0, sample_idx.view(-1)).detach()
+			weight_s = weight_s.view(bs, self.N + 1, feat_dim)
+			out_t = torch.bmm(weight_s, feat_t.to(weight_s.dtype).view(bs, feat_dim, 1)).to(feat_t.dtype)
+			out_t = torch.exp(torch.div(out_t, self.T)).squeeze().contiguous()
 
-		# using student as anchor
-		weight_t = torch.index_select(self.memory_t, 0, sample_idx.view(-1)).detach()
-		weight_t = weight_t.view(bs, self.N + 1, feat_dim)
-		out_s = torch.bmm(weight_t, feat_s.view(bs, feat_dim, 1))
-		out_s = torch.exp(torch.div(out_s, self.T)).squeeze().contiguous()
+			# using student as anchor
+			weight_t = torch.index_select(self.memory_t, 0, sample_idx.view(-1)).detach()
+			weight_t = weight_t.view(bs, self.N + 1, feat_dim)
+			out_s = torch.bmm(weight_t, feat_s.to(weight_t.dtype).view(bs, feat_dim, 1)).to(feat_s.dtype)
+			out_s = torch.exp(torch.div(out_s, self.T)).squeeze().contiguous()
 
 		# set Z if haven't been set yet
 		if self.Z_t is None:
@@ -127,18 +289,10 @@ class ContrastMemory(nn.Module):
 		out_s = torch.div(out_s, self.Z_s)
 
 		# update memory
-		with torch.no_grad():
-			pos_mem_t = torch.index_select(self.memory_t, 0, idx.view(-1))
-			pos_mem_t.mul_(self.momentum)
-			pos_mem_t.add_(torch.mul(feat_t, 1 - self.momentum))
-			pos_mem_t = F.normalize(pos_mem_t, p=2, dim=1)
-			self.memory_t.index_copy_(0, idx, pos_mem_t)
-
-			pos_mem_s = torch.index_select(self.memory_s, 0, idx.view(-1))
-			pos_mem_s.mul_(self.momentum)
-			pos_mem_s.add_(torch.mul(feat_s, 1 - self.momentum))
-			pos_mem_s = F.normalize(pos_mem_s, p=2, dim=1)
-			self.memory_s.index_copy_(0, idx, pos_mem_s)
+		if self.chunk > 0:
+			self.pending = (idx, feat_s.detach(), feat_t.detach())
+		else:
+			self.update(idx, feat_s, feat_t)
 
 		return out_s, out_t
 
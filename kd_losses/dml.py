@@ -7,13 +7,15 @@ import torch.nn.functional as F
 
 
 '''
-DML with only two networks
+DML with two networks (DML) or a cohort of any size (CohortDML)
 '''
 class DML(nn.Module):
 	'''
 	Deep Mutual Learning
 	https://zpascal.net/cvpr2018/Zhang_Deep_Mutual_Learning_CVPR_2018_paper.pdf
 	'''
+	taps = ['out']
+
 	def __init__(self):
 		super(DML, self).__init__()
 
@@ -23,3 +25,32 @@ class DML(nn.Module):
 						reduction='batchmean')
 
 		return loss
+
+
+class CohortDML(nn.Module):
+	'''
+	Deep Mutual Learning for a cohort of N nets
+	https://zpascal.net/cvpr2018/Zhang_Deep_Mutual_Learning_CVPR_2018_paper.pdf
+
+	outs: N x B x C logits of the cohort. Returns the N losses of the nets, the mean
+	KL from every other (detached) peer. As the KL sums over the peers,
+		sum_j KL(p_j||p_i) = sum_j sum_c p_j*log(p_j) - sum_c (sum_j p_j)*log(p_i)
+	all N*(N-1) pairs come from one pass over the logits; the j=i term is zero in
+	value and gradient, so it is not excluded.
+	'''
+	taps = ['out']
+
+	def __init__(self):
+		super(CohortDML, self).__init__()
+
+	def forward(self, outs):
+		n = outs.size(0)
+		log_p = F.log_softmax(outs, dim=2)
+		log_p_t = log_p.detach()
+		p_t = log_p_t.exp()
+
+		neg_ent = (p_t * log_p_t).sum(dim=2).sum(dim=0)
+		cross = (p_t.sum(dim=0, keepdim=True) * log_p).sum(dim=2)
+		loss = (neg_ent.unsqueeze(0) - cross).mean(dim=1) / (n - 1)
+
+		return loss
@@ -11,6 +11,8 @@ class Hint(nn.Module):
 	FitNets: Hints for Thin Deep Nets
 	https://arxiv.org/pdf/1412.6550.pdf
 	'''
+	taps = ['rb3']
+
 	def __init__(self):
 		super(Hint, self).__init__()
 
@@ -11,6 +11,8 @@ class FSP(nn.Module):
 	A Gift from Knowledge Distillation: Fast Optimization, Network Minimization and Transfer Learning
 	http://openaccess.thecvf.com/content_cvpr_2017/papers/Yim_A_Gift_From_CVPR_2017_paper.pdf
 	'''
+	taps = ['stem', 'rb1', 'rb2', 'rb3']
+
 	def __init__(self):
 		super(FSP, self).__init__()
 
@@ -11,6 +11,8 @@ class FT(nn.Module):
 	araphrasing Complex Network: Network Compression via Factor Transfer
 	http://papers.nips.cc/paper/7541-paraphrasing-complex-network-network-compression-via-factor-transfer.pdf
 	'''
+	taps = ['rb3']
+
 	def __init__(self):
 		super(FT, self).__init__()
 
@@ -5,6 +5,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .relations import pdist, mse_sym
+
 
 class IRG(nn.Module):
 	'''
@@ -15,6 +17,8 @@ class IRG(nn.Module):
 	The official code is written by Caffe
 	https://github.com/yufanLIU/IRG
 	'''
+	taps = ['rb2', 'rb3', 'feat', 'out']
+
 	def __init__(self, w_irg_vert, w_irg_edge, w_irg_tran):
 		super(IRG, self).__init__()
 
@@ -34,9 +38,9 @@ class IRG(nn.Module):
 		irg_edge_fm_t1  = self.euclidean_dist_fm(fm_t1, squared=True)
 		irg_edge_fm_s2  = self.euclidean_dist_fm(fm_s2, squared=True)
 		irg_edge_fm_t2  = self.euclidean_dist_fm(fm_t2, squared=True)
-		loss_irg_edge = (F.mse_loss(irg_edge_feat_s, irg_edge_feat_t) +
-						 F.mse_loss(irg_edge_fm_s1,  irg_edge_fm_t1 ) +
-						 F.mse_loss(irg_edge_fm_s2,  irg_edge_fm_t2 )) / 3.0
+		loss_irg_edge = (mse_sym(irg_edge_feat_s, irg_edge_feat_t) +
+						 mse_sym(irg_edge_fm_s1,  irg_edge_fm_t1 ) +
+						 mse_sym(irg_edge_fm_s2,  irg_edge_fm_t2 )) / 3.0
 
 		irg_tran_s = self.euclidean_dist_fms(fm_s1, fm_s2, squared=True)
 		irg_tran_t = self.euclidean_dist_fms(fm_t1, fm_t2, squared=True)
@@ -73,37 +77,14 @@ class IRG(nn.Module):
 
 		return fms_dist
 
-	def euclidean_dist_fm(self, fm, squared=False, eps=1e-12): 
+	def euclidean_dist_fm(self, fm, squared=False, eps=1e-12):
 		'''
-		Calculating the IRG edge of feature map. 
+		Calculating the IRG edge of feature map.
 		'''
-		fm = fm.view(fm.size(0), -1)
-		fm_square = fm.pow(2).sum(dim=1)
-		fm_prod   = torch.mm(fm, fm.t())
-		fm_dist   = (fm_square.unsqueeze(0) + fm_square.unsqueeze(1) - 2 * fm_prod).clamp(min=eps)
-
-		if not squared:
-			fm_dist = fm_dist.sqrt()
-
-		fm_dist = fm_dist.clone()
-		fm_dist[range(len(fm)), range(len(fm))] = 0
-		fm_dist = fm_dist / fm_dist.max()
-
-		return fm_dist
+		return pdist(fm, squared=squared, max_normalize=True, eps=eps)
 
 	def euclidean_dist_feat(self, feat, squared=False, eps=1e-12):
 		'''
 		Calculating the IRG edge of feat.
 		'''
-		feat_square = feat.pow(2).sum(dim=1)
-		feat_prod   = torch.mm(feat, feat.t())
-		feat_dist   = (feat_square.unsqueeze(0) + feat_square.unsqueeze(1) - 2 * feat_prod).clamp(min=eps)
-
-		if not squared:
-			feat_dist = feat_dist.sqrt()
-
-		feat_dist = feat_dist.clone()
-		feat_dist[range(len(feat)), range(len(feat))] = 0
-		feat_dist = feat_dist / feat_dist.max()
-
-		return feat_dist
\ No newline at end of file
+		return pdist(feat, squared=squared, max_normalize=True, eps=eps)
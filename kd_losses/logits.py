@@ -11,6 +11,8 @@ class Logits(nn.Module):
 	Do Deep Nets Really Need to be Deep?
 	http://papers.nips.cc/paper/5484-do-deep-nets-really-need-to-be-deep.pdf
 	'''
+	taps = ['out']
+
 	def __init__(self):
 		super(Logits, self).__init__()
 
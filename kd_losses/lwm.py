@@ -17,6 +17,9 @@ class LwM(nn.Module):
 	Learning without Memorizing
 	https://arxiv.org/pdf/1811.08051.pdf
 	'''
+	taps = ['out', 'rb2']
+	teacher_grad = True
+
 	def __init__(self):
 		super(LwM, self).__init__()
 
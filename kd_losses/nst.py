@@ -39,24 +39,62 @@ class NST(nn.Module):
 	'''
 	Like What You Like: Knowledge Distill via Neuron Selectivity Transfer
 	https://arxiv.org/pdf/1707.01219.pdf
+
+	The kernel of two channels is the square of their inner product, so the mean of
+	the kernel over the channel pairs of fm1 (C1 x HW) and fm2 (C2 x HW) is
+		mean((fm1 fm2^T)^2) = <fm1^T fm1, fm2^T fm2> / (C1 C2)
+	and the loss is |fm_s^T fm_s / C_s - fm_t^T fm_t / C_t|^2 per sample.
+	gram:     'spatial' the HW x HW Gram matrices of the last form
+	          'channel' the C1 x C2 bmm of the first form
+	          'auto'    the smaller of the two
+	          'full'    the original B x C x C x HW products
+	channels: if > 0, the kernels are estimated on that many randomly sampled
+	          channels of each feature map (for very wide teachers)
 	'''
-	def __init__(self):
+	taps = ['rb3']
+
+	def __init__(self, gram='auto', channels=0):
 		super(NST, self).__init__()
+		if gram not in ('auto', 'spatial', 'channel', 'full'):
+			raise Exception('Invalid NST gram form {}...'.format(gram))
+		self.gram = gram
+		self.channels = channels
 
 	def forward(self, fm_s, fm_t):
 		fm_s = fm_s.view(fm_s.size(0), fm_s.size(1), -1)
-		fm_s = F.normalize(fm_s, dim=2)
+		fm_s = F.normalize(self.sample_channels(fm_s), dim=2)
 
 		fm_t = fm_t.view(fm_t.size(0), fm_t.size(1), -1)
-		fm_t = F.normalize(fm_t, dim=2)
+		fm_t = F.normalize(self.sample_channels(fm_t), dim=2)
+
+		gram = self.gram
+		if gram == 'auto':
+			# multiply-adds of the two forms
+			hw, c_s, c_t = fm_s.size(2), fm_s.size(1), fm_t.size(1)
+			gram = 'spatial' if hw * (c_s + c_t) < c_s * c_s + c_t * c_t + c_s * c_t else 'channel'
 
-		loss = self.poly_kernel(fm_t, fm_t).mean() \
-			 + self.poly_kernel(fm_s, fm_s).mean() \
-			 - 2 * self.poly_kernel(fm_s, fm_t).mean()
+		if gram == 'spatial':
+			gram_s = torch.bmm(fm_s.transpose(1, 2), fm_s) / fm_s.size(1)
+			gram_t = torch.bmm(fm_t.transpose(1, 2), fm_t) / fm_t.size(1)
+			return (gram_s - gram_t).pow(2).sum(dim=(1, 2)).mean()
+
+		poly_kernel = self.poly_kernel if gram == 'channel' else self.poly_kernel_full
+		loss = poly_kernel(fm_t, fm_t).mean() \
+			 + poly_kernel(fm_s, fm_s).mean() \
+			 - 2 * poly_kernel(fm_s, fm_t).mean()
 
 		return loss
 
+	def sample_channels(self, fm):
+		if self.channels <= 0 or fm.size(1) <= self.channels:
+			return fm
+		idx = torch.randperm(fm.size(1), device=fm.device)[:self.channels]
+		return fm[:, idx]
+
 	def poly_kernel(self, fm1, fm2):
+		return torch.bmm(fm2, fm1.transpose(1, 2)).pow(2)
+
+	def poly_kernel_full(self, fm1, fm2):
 		fm1 = fm1.unsqueeze(1)
 		fm2 = fm2.unsqueeze(2)
 		out = (fm1 * fm2).sum(-1).pow(2)
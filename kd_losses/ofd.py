@@ -16,6 +16,8 @@ class OFD(nn.Module):
 	http://openaccess.thecvf.com/content_ICCV_2019/papers/
 	Heo_A_Comprehensive_Overhaul_of_Feature_Distillation_ICCV_2019_paper.pdf
 	'''
+	taps = ['rb1_pre', 'rb2_pre', 'rb3_pre']
+
 	def __init__(self, in_channels, out_channels):
 		super(OFD, self).__init__()
 		self.connector = nn.Sequential(*[
@@ -4,6 +4,9 @@ from __future__ import division
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+from .relations import cos_sim, normalize_rows
 
 
 '''
@@ -13,34 +16,59 @@ class PKTCosSim(nn.Module):
 	'''
 	Learning Deep Representations with Probabilistic Knowledge Transfer
 	http://openaccess.thecvf.com/content_ECCV_2018/papers/Nikolaos_Passalis_Learning_Deep_Representations_ECCV_2018_paper.pdf
+
+	With block the loss is computed over blocks of that many rows of the N x N
+	matrices, each recomputed in backward, so only one block is live at a time.
 	'''
-	def __init__(self):
+	taps = ['feat']
+
+	def __init__(self, block=0):
 		super(PKTCosSim, self).__init__()
+		self.block = block
 
 	def forward(self, feat_s, feat_t, eps=1e-6):
-		# Normalize each vector by its norm
-		feat_s_norm = torch.sqrt(torch.sum(feat_s ** 2, dim=1, keepdim=True))
-		feat_s = feat_s / (feat_s_norm + eps)
-		feat_s[feat_s != feat_s] = 0
+		# the vectors divided by their norm + eps
+		norm_s = normalize_rows(feat_s, eps=eps, add_eps=True)
+		norm_t = normalize_rows(feat_t, eps=eps, add_eps=True)
+		sum_s, sum_t = norm_s.sum(dim=0), norm_t.sum(dim=0)
+		n = norm_s.size(0)
 
-		feat_t_norm = torch.sqrt(torch.sum(feat_t ** 2, dim=1, keepdim=True))
-		feat_t = feat_t / (feat_t_norm + eps)
-		feat_t[feat_t != feat_t] = 0
+		if not self.block or self.block >= n:
+			loss = self.block_loss(cos_sim(feat_s, eps=eps, add_eps=True), norm_s, sum_s,
+								   cos_sim(feat_t, eps=eps, add_eps=True), norm_t, sum_t, eps)
+			return loss / (n * n)
 
-		# Calculate the cosine similarity
-		feat_s_cos_sim = torch.mm(feat_s, feat_s.transpose(0, 1))
-		feat_t_cos_sim = torch.mm(feat_t, feat_t.transpose(0, 1))
+		loss = 0.0
+		for start in range(0, n, self.block):
+			stop = min(start + self.block, n)
+			if torch.is_grad_enabled():
+				loss = loss + checkpoint(self.rows_loss, norm_s, sum_s, norm_t, sum_t, start, stop, eps,
+										 use_reentrant=False)
+			else:
+				loss = loss + self.rows_loss(norm_s, sum_s, norm_t, sum_t, start, stop, eps)
 
-		# Scale cosine similarity to [0,1]
-		feat_s_cos_sim = (feat_s_cos_sim + 1.0) / 2.0
-		feat_t_cos_sim = (feat_t_cos_sim + 1.0) / 2.0
+		return loss / (n * n)
 
-		# Transform them into probabilities
-		feat_s_cond_prob = feat_s_cos_sim / torch.sum(feat_s_cos_sim, dim=1, keepdim=True)
-		feat_t_cond_prob = feat_t_cos_sim / torch.sum(feat_t_cos_sim, dim=1, keepdim=True)
+	def rows_loss(self, norm_s, sum_s, norm_t, sum_t, start, stop, eps):
+		rows_s, rows_t = norm_s[start:stop], norm_t[start:stop]
+		return self.block_loss(torch.mm(rows_s, norm_s.t()), rows_s, sum_s,
+							   torch.mm(rows_t, norm_t.t()), rows_t, sum_t, eps)
 
-		# Calculate the KL-divergence
-		loss = torch.mean(feat_t_cond_prob * torch.log((feat_t_cond_prob + eps) / (feat_s_cond_prob + eps)))
+	def block_loss(self, sim_s, rows_s, sum_s, sim_t, rows_t, sum_t, eps):
+		'''
+		Sum over the rows of the KL-divergence of the original, with the cosine
+		similarity scaled to [0,1] and each row transformed into probabilities:
+		p = (sim + 1) / den, den = 2 * the row sum of (sim + 1) / 2 = n + x_i . sum_j x_j
+		'''
+		n = sim_s.size(1)
+		den_s = torch.mv(rows_s, sum_s).add_(n)
+		with torch.no_grad():
+			den_t = torch.mv(rows_t, sum_t).add_(n)
+			prob_t = sim_t.add(1.0).div_(den_t.unsqueeze(1))
+			ent_t = torch.dot(prob_t.reshape(-1), prob_t.add(eps).log_().reshape(-1))
 
-		return loss
+		# log(p_s + eps) = log(sim_s + 1 + eps * den_s) - log(den_s)
+		log_s = torch.log(sim_s + (1.0 + eps * den_s).unsqueeze(1))
+		cross = torch.dot(prob_t.reshape(-1), log_s.reshape(-1)) - torch.dot(prob_t.sum(dim=1), den_s.log())
 
+		return ent_t - cross
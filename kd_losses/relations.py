@@ -0,0 +1,142 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+import contextlib
+import torch
+import torch.nn.functional as F
+
+
+'''
+Pairwise relation kernels of the relational kd losses (RKD, IRG, SP, CC, PKT).
+
+Every kernel takes a batch of features or feature maps (N x ...) and returns an
+N x N matrix. The diagonal is zeroed and the matrix normalized in place on the
+tensor the kernel just computed, wherever autograd allows it (always for the
+teacher). Distance matrices are symmetric with a zero diagonal, mse_sym and
+smooth_l1_sym reduce a loss over their strict upper triangle only.
+
+Inside `with relation_cache():` every kernel result is kept until the block exits,
+keyed by the kernel, its arguments and the input tensor (identity and version), so
+a matrix computed by one loss is reused by any other loss of the same step. Kernel
+results are shared and must not be modified by the losses.
+'''
+
+_cache = None
+
+
+@contextlib.contextmanager
+def relation_cache():
+	global _cache
+	outer = _cache
+	if outer is None:
+		_cache = {}
+	try:
+		yield
+	finally:
+		_cache = outer
+
+
+def cached(name, x, fn, *args):
+	if _cache is None:
+		return fn()
+	key = (name, id(x), x._version) + args
+	if key not in _cache:
+		# the entry keeps x alive, so its id is not reused within the block
+		_cache[key] = (x, fn())
+	return _cache[key][1]
+
+
+def flat(x):
+	return x.reshape(x.size(0), -1)
+
+
+def center(feat):
+	# distances do not change with a translation, centered features keep the Gram
+	# expansion of the distances from cancelling on large norms
+	return cached('center', feat, lambda: flat(feat) - flat(feat).mean(dim=0, keepdim=True))
+
+
+def _max_normalize(mat):
+	# max() saves its input for backward
+	if mat.requires_grad:
+		return mat / mat.max()
+	return mat.div_(mat.max())
+
+
+def gram(feat, normalize=False, eps=1e-12):
+	'''
+	flat(feat) flat(feat)^T, with normalize every row scaled to unit L2 norm as
+	F.normalize(dim=1).
+	'''
+	def fn():
+		x = flat(feat)
+		g = torch.mm(x, x.t())
+		if not normalize:
+			return g
+		if g.requires_grad:
+			return F.normalize(g, p=2, dim=1, eps=eps)
+		return g.div_(g.norm(p=2, dim=1, keepdim=True).clamp_(min=eps))
+	return cached('gram', feat, fn, normalize, eps)
+
+
+def pdist(feat, squared=False, max_normalize=False, eps=1e-12):
+	'''
+	Euclidean (or squared) distances clamped at eps with a zero diagonal, with
+	max_normalize divided by their maximum.
+	'''
+	def fn():
+		g = gram(center(feat))
+		diag = g.diagonal()
+		d = (diag.unsqueeze(0) + diag.unsqueeze(1) - 2 * g).clamp(min=eps)
+		if squared:
+			# the backward of clamp does not need its output
+			d.fill_diagonal_(0)
+		else:
+			d = d.sqrt()
+			# sqrt saves its output, zeroed after the sqrt the diagonal gets no gradient
+			if d.requires_grad:
+				d = d.masked_fill(torch.eye(d.size(0), dtype=torch.bool, device=d.device), 0)
+			else:
+				d.fill_diagonal_(0)
+		if max_normalize:
+			d = _max_normalize(d)
+		return d
+	return cached('pdist', feat, fn, squared, max_normalize, eps)
+
+
+def normalize_rows(feat, eps=1e-12, add_eps=False):
+	'''
+	Unit L2 rows of flat(feat): x / max(|x|, eps) as F.normalize, or with add_eps
+	x / (|x| + eps) with NaN set to 0.
+	'''
+	def fn():
+		x = flat(feat)
+		if not add_eps:
+			return F.normalize(x, p=2, dim=1, eps=eps)
+		x = x / (x.norm(p=2, dim=1, keepdim=True) + eps)
+		# the backward of the division does not need its output
+		return x.nan_to_num_(nan=0.0)
+	return cached('normalize_rows', feat, fn, eps, add_eps)
+
+
+def cos_sim(feat, eps=1e-12, add_eps=False):
+	return cached('cos_sim', feat, lambda: gram(normalize_rows(feat, eps, add_eps)), eps, add_eps)
+
+
+def triu(mat):
+	# the strict upper triangle of a square matrix as a vector
+	n = mat.size(0)
+	idx = torch.triu_indices(n, n, offset=1, device=mat.device)
+	return mat[idx[0], idx[1]]
+
+
+def mse_sym(mat_s, mat_t):
+	# F.mse_loss of two symmetric matrices with zero diagonals
+	n = mat_s.size(0)
+	return 2.0 * F.mse_loss(triu(mat_s), triu(mat_t), reduction='sum') / (n * n)
+
+
+def smooth_l1_sym(mat_s, mat_t):
+	# F.smooth_l1_loss of two symmetric matrices with zero diagonals
+	n = mat_s.size(0)
+	return 2.0 * F.smooth_l1_loss(triu(mat_s), triu(mat_t), reduction='sum') / (n * n)
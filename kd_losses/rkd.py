@@ -4,6 +4,9 @@ from __future__ import division
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+from .relations import pdist, gram, center, triu, smooth_l1_sym
 
 
 '''
@@ -14,11 +17,22 @@ class RKD(nn.Module):
 	Relational Knowledge Distillation
 	https://arxiv.org/pdf/1904.05068.pdf
 	'''
-	def __init__(self, w_dist, w_angle):
+	taps = ['feat']
+
+	# angle:     'full' the N x N x C difference vectors and an N x N x N bmm
+	#            'gram' the same angles from the N x N Gram matrix, in tiles of anchors
+	#                   bounded by budget_mb, each tile recomputed in backward
+	#            'sample' n_triplets random triplets
+	def __init__(self, w_dist, w_angle, angle='gram', budget_mb=64, n_triplets=4096):
 		super(RKD, self).__init__()
 
 		self.w_dist  = w_dist
 		self.w_angle = w_angle
+		if angle not in ('full', 'gram', 'sample'):
+			raise Exception('Invalid RKD angle mode {}...'.format(angle))
+		self.angle = angle
+		self.budget_mb = budget_mb
+		self.n_triplets = n_triplets
 
 	def forward(self, feat_s, feat_t):
 		loss = self.w_dist * self.rkd_dist(feat_s, feat_t) + \
@@ -27,19 +41,25 @@ class RKD(nn.Module):
 		return loss
 
 	def rkd_dist(self, feat_s, feat_t):
-		feat_t_dist = self.pdist(feat_t, squared=False)
-		mean_feat_t_dist = feat_t_dist[feat_t_dist>0].mean()
-		feat_t_dist = feat_t_dist / mean_feat_t_dist
+		# symmetric, the mean of the positive distances is the one of the upper triangle
+		feat_t_dist = pdist(feat_t, squared=False)
+		triu_t_dist = triu(feat_t_dist)
+		feat_t_dist = feat_t_dist / triu_t_dist[triu_t_dist>0].mean()
 
-		feat_s_dist = self.pdist(feat_s, squared=False)
-		mean_feat_s_dist = feat_s_dist[feat_s_dist>0].mean()
-		feat_s_dist = feat_s_dist / mean_feat_s_dist
+		feat_s_dist = pdist(feat_s, squared=False)
+		triu_s_dist = triu(feat_s_dist)
+		feat_s_dist = feat_s_dist / triu_s_dist[triu_s_dist>0].mean()
 
-		loss = F.smooth_l1_loss(feat_s_dist, feat_t_dist)
+		loss = smooth_l1_sym(feat_s_dist, feat_t_dist)
 
 		return loss
 
 	def rkd_angle(self, feat_s, feat_t):
+		if self.angle == 'gram':
+			return self.rkd_angle_gram(feat_s, feat_t)
+		if self.angle == 'sample':
+			return self.rkd_angle_sample(feat_s, feat_t)
+
 		# N x C --> N x N x C
 		feat_t_vd = (feat_t.unsqueeze(0) - feat_t.unsqueeze(1))
 		norm_feat_t_vd = F.normalize(feat_t_vd, p=2, dim=2)
@@ -53,17 +73,62 @@ class RKD(nn.Module):
 
 		return loss
 
-	def pdist(self, feat, squared=False, eps=1e-12):
-		feat_square = feat.pow(2).sum(dim=1)
-		feat_prod   = torch.mm(feat, feat.t())
-		feat_dist   = (feat_square.unsqueeze(0) + feat_square.unsqueeze(1) - 2 * feat_prod).clamp(min=eps)
-
-		if not squared:
-			feat_dist = feat_dist.sqrt()
-
-		feat_dist = feat_dist.clone()
-		feat_dist[range(len(feat)), range(len(feat))] = 0
-
-		return feat_dist
-
-
+	def rkd_angle_gram(self, feat_s, feat_t):
+		# angle[i,j,k] = <x_j-x_i, x_k-x_i> / (|x_j-x_i| |x_k-x_i|)
+		#              = (G_jk - G_ij - G_ik + G_ii) / (D_ij D_ik)
+		# zero where a difference vector is zero, as F.normalize gives
+		n = feat_s.size(0)
+		gram_s, inv_s = self.gram_inv_dist(feat_s)
+		gram_t, inv_t = self.gram_inv_dist(feat_t)
+
+		# about 6 live N x N tiles of fp32 per anchor in the tile
+		tile = max(1, min(n, int(self.budget_mb * 1e6 // (6 * 4 * n * n))))
+		loss = 0.0
+		for start in range(0, n, tile):
+			stop = min(start + tile, n)
+			if torch.is_grad_enabled():
+				loss = loss + checkpoint(self.angle_tile_loss, gram_s, inv_s, gram_t, inv_t, start, stop,
+										 use_reentrant=False)
+			else:
+				loss = loss + self.angle_tile_loss(gram_s, inv_s, gram_t, inv_t, start, stop)
+
+		return loss / (n * n * n)
+
+	def angle_tile_loss(self, gram_s, inv_s, gram_t, inv_t, start, stop):
+		angle_s = self.angle_tile(gram_s, inv_s, start, stop)
+		angle_t = self.angle_tile(gram_t, inv_t, start, stop)
+
+		return F.smooth_l1_loss(angle_s, angle_t, reduction='sum')
+
+	def angle_tile(self, gram_mat, inv, start, stop):
+		# anchors start..stop-1: (stop-start) x N x N
+		g = gram_mat[start:stop]
+		g_ii = g[range(stop - start), range(start, stop)]
+		angle = gram_mat.unsqueeze(0) - g.unsqueeze(2) - g.unsqueeze(1) + g_ii.view(-1, 1, 1)
+
+		return angle * inv[start:stop].unsqueeze(2) * inv[start:stop].unsqueeze(1)
+
+	def gram_inv_dist(self, feat, eps=1e-12):
+		# centered, so that the Gram differences do not cancel on large norms; the
+		# same Gram matrix as the one of rkd_dist
+		g = gram(center(feat))
+		diag = g.diagonal()
+		dist_sq = diag.unsqueeze(0) + diag.unsqueeze(1) - 2 * g
+		# rsqrt of the clamped squares keeps the gradient finite on the zero diagonal
+		inv_dist = torch.where(dist_sq > eps * eps, dist_sq.clamp(min=eps * eps).rsqrt(), torch.zeros_like(dist_sq))
+
+		return g, inv_dist
+
+	def rkd_angle_sample(self, feat_s, feat_t):
+		# the same random (i, j, k) triplets for the student and the teacher
+		n = feat_s.size(0)
+		idx = torch.randint(n, (3, self.n_triplets), device=feat_s.device)
+
+		return F.smooth_l1_loss(self.triplet_angle(feat_s, idx), self.triplet_angle(feat_t, idx))
+
+	def triplet_angle(self, feat, idx):
+		anchor = feat[idx[0]]
+		vd_j = F.normalize(feat[idx[1]] - anchor, p=2, dim=1)
+		vd_k = F.normalize(feat[idx[2]] - anchor, p=2, dim=1)
+
+		return (vd_j * vd_k).sum(dim=1)
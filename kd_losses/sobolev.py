@@ -15,6 +15,9 @@ class Sobolev(nn.Module):
 	Knowledge Transfer with Jacobian Matching
 	http://de.arxiv.org/pdf/1803.00443
 	'''
+	taps = ['out']
+	teacher_grad = True
+
 	def __init__(self):
 		super(Sobolev, self).__init__()
 
@@ -5,23 +5,22 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .relations import gram
+
 
 class SP(nn.Module):
 	'''
 	Similarity-Preserving Knowledge Distillation
 	https://arxiv.org/pdf/1907.09682.pdf
 	'''
+	taps = ['rb1', 'rb2', 'rb3']
+
 	def __init__(self):
 		super(SP, self).__init__()
 
 	def forward(self, fm_s, fm_t):
-		fm_s = fm_s.view(fm_s.size(0), -1)
-		G_s  = torch.mm(fm_s, fm_s.t())
-		norm_G_s = F.normalize(G_s, p=2, dim=1)
-
-		fm_t = fm_t.view(fm_t.size(0), -1)
-		G_t  = torch.mm(fm_t, fm_t.t())
-		norm_G_t = F.normalize(G_t, p=2, dim=1)
+		norm_G_s = gram(fm_s, normalize=True)
+		norm_G_t = gram(fm_t, normalize=True)
 
 		loss = F.mse_loss(norm_G_s, norm_G_t)
 
@@ -11,6 +11,8 @@ class SoftTarget(nn.Module):
 	Distilling the Knowledge in a Neural Network
 	https://arxiv.org/pdf/1503.02531.pdf
 	"""
+	taps = ['out']
+
 	def __init__(self, T):
 		super(SoftTarget, self).__init__()
 		self.T = T
@@ -20,4 +22,49 @@ class SoftTarget(nn.Module):
 						F.softmax(out_t/self.T, dim=1),
 						reduction='batchmean') * self.T * self.T
 
-		return loss
\ No newline at end of file
+		return loss
+
+
+def topk_logits(out_t, k, T):
+	'''
+	Compact form of the teacher logits: the top-k logits, their class indices and the
+	log-sum-exp of the remaining logits at temperature T.
+	'''
+	if k >= out_t.size(1):
+		raise Exception('k should be smaller than the number of classes...')
+	val_t, idx_t = out_t.topk(k, dim=1)
+	rest_t = out_t.scatter(1, idx_t, float('-inf'))
+	lse_rest_t = torch.logsumexp(rest_t / T, dim=1)
+
+	return val_t, idx_t, lse_rest_t
+
+
+class SparseSoftTarget(nn.Module):
+	'''
+	SoftTarget on the output of topk_logits(). The top-k classes keep their exact
+	teacher probabilities, the remaining classes are merged into one bucket on both
+	the teacher and the student side. The teacher is never densified.
+	'''
+	taps = ['out']
+
+	def __init__(self, T):
+		super(SparseSoftTarget, self).__init__()
+		self.T = T
+
+	def forward(self, out_s, topk_t):
+		val_t, idx_t, lse_rest_t = topk_t
+
+		log_s = F.log_softmax(out_s/self.T, dim=1)
+		log_s_top  = log_s.gather(1, idx_t)
+		log_s_rest = torch.logsumexp(log_s.scatter(1, idx_t, float('-inf')), dim=1)
+
+		val_t = val_t / self.T
+		log_z_t = torch.logaddexp(torch.logsumexp(val_t, dim=1), lse_rest_t)
+		log_t_top  = val_t - log_z_t.unsqueeze(1)
+		log_t_rest = lse_rest_t - log_z_t
+
+		loss = (log_t_top.exp() * (log_t_top - log_s_top)).sum(1) + \
+			   log_t_rest.exp() * (log_t_rest - log_s_rest)
+		loss = loss.mean() * self.T * self.T
+
+		return loss
@@ -20,6 +20,8 @@ class VID(nn.Module):
 	Variational Information Distillation for Knowledge Transfer
 	https://zpascal.net/cvpr2019/Ahn_Variational_Information_Distillation_for_Knowledge_Transfer_CVPR_2019_paper.pdf
 	'''
+	taps = ['rb1', 'rb2', 'rb3']
+
 	def __init__(self, in_channels, mid_channels, out_channels, init_var, eps=1e-6):
 		super(VID, self).__init__()
 		self.eps = eps
@@ -0,0 +1,118 @@
+"""Feature taps of the networks in models/.
+
+A kd loss names the intermediate outputs it reads (its `taps`), they are captured
+with forward hooks on the layers that produce them instead of being returned by the
+forward of the network, so every other activation is released as soon as the forward
+moves on.
+
+Tap names:
+    stem, rb1, rb2, rb3   output of the stem and of the first three residual stages
+    stem_pre, rb1_pre, .. the same before the last ReLU
+    feat                  input of the classifier
+    out                   logits
+"""
+import threading
+
+import torch
+import torch.nn as nn
+
+
+TAPS = ('stem', 'rb1', 'rb2', 'rb3', 'feat', 'out')
+PRE_TAPS = ('stem_pre', 'rb1_pre', 'rb2_pre', 'rb3_pre')
+
+
+def unwrap(net):
+    if isinstance(net, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        return net.module
+    return net
+
+
+def tap_layers(net):
+    # tap name -> (name of the module, 'input' or 'output' of the module)
+    net = unwrap(net)
+    if hasattr(net, 'tap_layers'):
+        return net.tap_layers()
+    # any other model of the zoo: the input and output of its last linear layer
+    linear = [name for name, m in net.named_modules() if isinstance(m, nn.Linear)]
+    if not linear:
+        raise Exception('No feature taps for {}...'.format(type(net).__name__))
+    return {'feat': (linear[-1], 'input'), 'out': (linear[-1], 'output')}
+
+
+def tap_channels(net):
+    # channels of every tap, by name
+    channels = dict(zip(TAPS, unwrap(net).get_channel_num()))
+    channels.update({name: channels[name[:-len('_pre')]] for name in PRE_TAPS})
+    return channels
+
+
+class FeatureTaps(object):
+    '''
+    Runs net and returns {tap: tensor} for the requested taps only. Works through
+    DataParallel, the per-device pieces of a tap are concatenated like the output.
+    '''
+
+    def __init__(self, net):
+        self.net = net
+        self.layers = tap_layers(net)
+        self.active = frozenset()
+        self.features = {}
+        self.lock = threading.Lock()
+        self.handles = []
+        modules = dict(unwrap(net).named_modules())
+        for module_name in sorted(set(m for m, _ in self.layers.values())):
+            taps = [(tap, where) for tap, (m, where) in self.layers.items() if m == module_name]
+            self.handles.append(modules[module_name].register_forward_hook(self._hook(taps)))
+
+    def _hook(self, taps):
+        def hook(module, inputs, output):
+            for tap, where in taps:
+                if tap in self.active:
+                    x = inputs[0] if where == 'input' else output
+                    device = -1 if x.device.index is None else x.device.index
+                    with self.lock:
+                        self.features.setdefault(tap, []).append((device, x))
+        return hook
+
+    def __call__(self, x, taps, forward=None):
+        # forward: runs net on x in place of net(x), e.g. a torch.func.functional_call
+        for tap in taps:
+            if tap not in self.layers:
+                raise Exception('Invalid feature tap {}...'.format(tap))
+        self.active = frozenset(taps) - {'out'}
+        self.features = {}
+        try:
+            out = self.net(x) if forward is None else forward(x)
+        finally:
+            self.active = frozenset()
+        if isinstance(out, tuple):
+            out = out[-1]
+
+        features = {}
+        for tap in taps:
+            if tap == 'out':
+                features[tap] = out
+                continue
+            parts = [f for _, f in sorted(self.features[tap], key=lambda p: p[0])]
+            if len(parts) == 1:
+                features[tap] = parts[0]
+            else:
+                features[tap] = torch.cat([f.to(out.device) for f in parts])
+        self.features = {}
+        return features
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+def feature_taps(net):
+    # one FeatureTaps per network, created on first use
+    if getattr(net, '_feature_taps', None) is None:
+        net._feature_taps = FeatureTaps(net)
+    return net._feature_taps
+
+
+def forward_taps(net, x, taps):
+    return feature_taps(net)(x, taps)
@@ -30,12 +30,13 @@ class BasicBlock(nn.Module):
                           kernel_size=1, stride=stride, bias=False),
                 nn.BatchNorm2d(self.expansion * planes)
             )
+        self.relu = nn.ReLU()  # a module, so that feature taps see the pre-activation
 
     def forward(self, x):
         out = F.relu(self.bn1(self.conv1(x)))
         out = self.bn2(self.conv2(out))
         out += self.shortcut(x)
-        out = F.relu(out)
+        out = self.relu(out)
         return out
 
 
@@ -60,24 +61,29 @@ class Bottleneck(nn.Module):
                           kernel_size=1, stride=stride, bias=False),
                 nn.BatchNorm2d(self.expansion * planes)
             )
+        self.relu = nn.ReLU()  # a module, so that feature taps see the pre-activation
 
     def forward(self, x):
         out = F.relu(self.bn1(self.conv1(x)))
         out = F.relu(self.bn2(self.conv2(out)))
         out = self.bn3(self.conv3(out))
         out += self.shortcut(x)
-        out = F.relu(out)
+        out = self.relu(out)
         return out
 
 
 class ResNet(nn.Module):
-    def __init__(self, block, num_blocks, num_classes=10):
+    def __init__(self, block, num_blocks, num_classes=10, return_features=True):
         super(ResNet, self).__init__()
         self.in_planes = 64
+        # False: forward returns the logits only, intermediate outputs are read
+        # with models.feature_taps
+        self.return_features = return_features
 
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3,
                                stride=1, padding=1, bias=False)
         self.bn1 = nn.BatchNorm2d(64)
+        self.relu = nn.ReLU()
         self.layer1 = self._make_layer(block, 64, num_blocks[0], stride=1)
         self.layer2 = self._make_layer(block, 128, num_blocks[1], stride=2)
         self.layer3 = self._make_layer(block, 256, num_blocks[2], stride=2)
@@ -92,11 +98,26 @@ class ResNet(nn.Module):
             self.in_planes = planes * block.expansion
         return nn.Sequential(*layers)
 
+    def get_channel_num(self):
+        # channels of stem, rb1, rb2, rb3, feat and out
+        expansion = self.linear.in_features // 512
+        return [64, 64 * expansion, 128 * expansion, 256 * expansion, 512 * expansion, self.linear.out_features]
+
+    def tap_layers(self):
+        # tap name -> (module, 'input'/'output'), see models/feature_taps.py
+        taps = {'stem_pre': ('relu', 'input'), 'stem': ('relu', 'output'),
+                'feat': ('linear', 'input'), 'out': ('linear', 'output')}
+        for i, layer in enumerate([self.layer1, self.layer2, self.layer3], start=1):
+            last = 'layer{}.{}.relu'.format(i, len(layer) - 1)
+            taps['rb{}_pre'.format(i)] = (last, 'input')
+            taps['rb{}'.format(i)] = (last, 'output')
+        return taps
+
     def forward(self, x):
         # out = F.relu(self.bn1(self.conv1(x)))
         pre_stem = self.conv1(x)  # pre_stem：pre stem before activation
         pre_stem = self.bn1(pre_stem)  # pre_stem：pre stem before activation
-        stem = F.relu(pre_stem)
+        stem = self.relu(pre_stem)
         # stem = (pre_stem, stem)
         rb1 = self.layer1(stem)  # pre_stem：pre stem before activation
         rb2 = self.layer2(rb1)
@@ -105,27 +126,29 @@ class ResNet(nn.Module):
         feat = F.avg_pool2d(rb4, 4)  # feat: feature map before fc and after residual block
         feat = feat.view(feat.size(0), -1)
         out = self.linear(feat)
+        if not self.return_features:
+            return out
         return stem, rb1, rb2, rb3, feat, out
 
 
-def ResNet18(num_classes: int = 10):
-    return ResNet(BasicBlock, [2, 2, 2, 2], num_classes=num_classes)
+def ResNet18(num_classes: int = 10, **kwargs):
+    return ResNet(BasicBlock, [2, 2, 2, 2], num_classes=num_classes, **kwargs)
 
 
-def ResNet34(num_classes: int = 10):
-    return ResNet(BasicBlock, [3, 4, 6, 3], num_classes=num_classes)
+def ResNet34(num_classes: int = 10, **kwargs):
+    return ResNet(BasicBlock, [3, 4, 6, 3], num_classes=num_classes, **kwargs)
 
 
-def ResNet50(num_classes: int = 10):
-    return ResNet(Bottleneck, [3, 4, 6, 3], num_classes=num_classes)
+def ResNet50(num_classes: int = 10, **kwargs):
+    return ResNet(Bottleneck, [3, 4, 6, 3], num_classes=num_classes, **kwargs)
 
 
-def ResNet101(num_classes: int = 10):
-    return ResNet(Bottleneck, [3, 4, 23, 3], num_classes=num_classes)
+def ResNet101(num_classes: int = 10, **kwargs):
+    return ResNet(Bottleneck, [3, 4, 23, 3], num_classes=num_classes, **kwargs)
 
 
-def ResNet152(num_classes: int = 10):
-    return ResNet(Bottleneck, [3, 8, 36, 3], num_classes=num_classes)
+def ResNet152(num_classes: int = 10, **kwargs):
+    return ResNet(Bottleneck, [3, 8, 36, 3], num_classes=num_classes, **kwargs)
 
 
 def test():
@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+import itertools
+from collections import OrderedDict
+
+import torch
+from torch.func import functional_call, vmap
+
+from models.feature_taps import feature_taps, forward_taps, unwrap
+
+'''
+Hyper-parameter sweeps with one teacher and K students in one process (train_kd.py
+--sweep). Every student keeps its own module, optimizer, scheduler, checkpoints and
+log; StudentStack runs the K student forwards as one torch.func.vmap call over their
+stacked parameters, so the teacher runs once per batch for all of them.
+'''
+
+
+def parse_sweep(args, specs):
+    '''
+    specs like ['lambda_kd=0.1,1.0', 'T=2,4'] -> one OrderedDict {arg: value} per
+    point of the grid, values are converted to the type of the default in args.
+    '''
+    names, grids = [], []
+    for spec in specs:
+        if '=' not in spec:
+            raise Exception('Invalid sweep {}, expected name=v1,v2,...'.format(spec))
+        name, values = spec.split('=', 1)
+        if not hasattr(args, name):
+            raise Exception('Invalid sweep argument {}...'.format(name))
+        cast = type(getattr(args, name))
+        names.append(name)
+        grids.append([cast(v) for v in values.split(',')])
+    return [OrderedDict(zip(names, point)) for point in itertools.product(*grids)]
+
+
+def sweep_name(setting):
+    return '_'.join('{}={}'.format(k, v) for k, v in setting.items())
+
+
+class StudentStack(object):
+    '''
+    Feature taps of K students of the same architecture on the same input. base is an
+    instance of the architecture (on the meta device, it holds no weights of its own).
+    With vectorize the parameters and buffers of the students are stacked on every
+    call and the forward is vmapped over them; the gradients flow back to the
+    parameters of each student, and the BatchNorm statistics updated in the stacked
+    buffers are copied back. Without vectorize the students run one after another.
+    Returns a list of K {tap: tensor} dicts.
+    '''
+
+    def __init__(self, nets, base, vectorize=True):
+        self.nets = [unwrap(net) for net in nets]
+        self.base = base
+        self.vectorize = vectorize
+
+    def _stacked(self, named):
+        names = [name for name, _ in named(self.nets[0])]
+        tensors = zip(*[[t for _, t in named(net)] for net in self.nets])
+        return OrderedDict((name, list(ts)) for name, ts in zip(names, tensors))
+
+    def __call__(self, x, taps):
+        if not self.vectorize:
+            return [forward_taps(net, x, taps) for net in self.nets]
+
+        params = {name: torch.stack(ps) for name, ps in
+                  self._stacked(lambda net: net.named_parameters()).items()}
+        student_buffers = self._stacked(lambda net: net.named_buffers())
+        buffers = {name: torch.stack([b.detach() for b in bs]) for name, bs in student_buffers.items()}
+        self.base.train(self.nets[0].training)
+        base_taps = feature_taps(self.base)
+
+        def student(p, b, x):
+            return base_taps(x, taps, forward=lambda x: functional_call(self.base, (p, b), (x,)))
+
+        out = vmap(student, in_dims=(0, 0, None))(params, buffers, x)
+
+        # BatchNorm updated the running statistics of the stacked copies
+        if self.base.training:
+            with torch.no_grad():
+                for name, bs in student_buffers.items():
+                    for k, b in enumerate(bs):
+                        b.copy_(buffers[name][k])
+        return [{tap: v[k] for tap, v in out.items()} for k in range(len(self.nets))]
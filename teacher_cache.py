@@ -0,0 +1,351 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+import os
+import json
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from torch.utils.data import Dataset, Sampler, DataLoader
+
+from kd_losses.st import topk_logits
+from models.feature_taps import forward_taps
+
+'''
+Offline cache of the outputs of a frozen teacher.
+
+Every training sample gets n_variants fixed augmentations (crop origin after reflect
+padding and a flip bit). The teacher is run once over all (sample, variant) pairs and
+the outputs a kd mode reads are stored in chunked, memory-mapped files. Training
+replays exactly those augmentations and reads the teacher outputs back instead of
+running the teacher.
+'''
+
+# teacher outputs (feature taps, see models/feature_taps.py) read by each kd mode
+# that can run from the cache
+CACHE_TAPS = {
+    'logits': ['out'],
+    'st': ['out'],
+    'fitnet': ['rb3'],
+    'nst': ['rb3'],
+    'at': ['rb1', 'rb2', 'rb3'],
+    'sp': ['rb1', 'rb2', 'rb3'],
+    'ab': ['rb1_pre', 'rb2_pre', 'rb3_pre'],
+    'fsp': ['stem', 'rb1', 'rb2', 'rb3'],
+}
+
+# fp16/bf16: plain half precision
+# int8:      symmetric int8 with one fp32 scale per channel (per sample for vectors)
+# topk:      kd_losses.st.topk_logits, only for logits
+CACHE_FORMATS = ('fp16', 'bf16', 'int8', 'topk')
+
+
+def make_aug_table(n_data, n_variants, padding=4, seed=0):
+    # aug_table[index, variant] = (crop row, crop col, flip)
+    rng = np.random.RandomState(seed)
+    aug_table = np.empty((n_data, n_variants, 3), dtype=np.uint8)
+    aug_table[..., :2] = rng.randint(0, 2 * padding + 1, size=(n_data, n_variants, 2))
+    aug_table[..., 2] = rng.randint(0, 2, size=(n_data, n_variants))
+    return aug_table
+
+
+def replay_aug(img, params, padding=4):
+    '''
+    Pad(padding, 'reflect') + RandomCrop + RandomHorizontalFlip with the crop origin
+    and the flip taken from params. img is a HxWxC uint8 array.
+    '''
+    h, w = img.shape[:2]
+    i, j, flip = params
+    img = np.pad(img, ((padding, padding), (padding, padding), (0, 0)), mode='reflect')
+    img = img[i:i + h, j:j + w]
+    if flip:
+        img = img[:, ::-1]
+    return np.ascontiguousarray(img)
+
+
+class ReplayAugDataset(Dataset):
+    '''
+    Wraps a torchvision CIFAR dataset and is indexed by (index, variant) pairs.
+    Returns img, target, index, variant, or img, target and the raw cached teacher
+    outputs of the sample once a complete cache is attached.
+    '''
+    def __init__(self, dataset, aug_table, mean, std, padding=4, cache=None):
+        self.data = dataset.data
+        self.targets = dataset.targets
+        self.aug_table = aug_table
+        self.padding = padding
+        self.cache = cache
+        self.transform = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize(mean=mean, std=std)
+        ])
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        index, variant = key
+        img = replay_aug(self.data[index], self.aug_table[index, variant], self.padding)
+        img = self.transform(img)
+
+        if self.cache is not None:
+            return img, self.targets[index], self.cache.read_sample(index, variant)
+        return img, self.targets[index], index, variant
+
+
+class ReplayAugSampler(Sampler):
+    '''
+    Yields (index, variant) pairs. With shuffle, each epoch visits every sample once
+    with a random variant. Without shuffle, all pairs are visited in storage order.
+    '''
+    def __init__(self, n_data, n_variants, shuffle=True):
+        self.n_data = n_data
+        self.n_variants = n_variants
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        if self.shuffle:
+            index = torch.randperm(self.n_data).tolist()
+            variant = torch.randint(self.n_variants, (self.n_data,)).tolist()
+            return iter(zip(index, variant))
+        return ((i, v) for i in range(self.n_data) for v in range(self.n_variants))
+
+    def __len__(self):
+        return self.n_data if self.shuffle else self.n_data * self.n_variants
+
+
+class TeacherCache(object):
+    '''
+    A directory with aug.npy (the augmentation table), progress.json and one memmap
+    <file>.<chunk>.npy of shape (chunk_size, n_variants, ...) per stored file and chunk
+    of samples. An output is stored in one or more files depending on its format, see
+    CACHE_FORMATS. Chunks are written one after the other and recorded in
+    progress.json, so an interrupted build resumes at the first missing chunk.
+    meta.json is written last and marks the cache as complete.
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.config = None
+        self.layout = {}  # file name -> (dtype, per sample shape)
+        self.aug_table = None
+        self.chunks_done = 0
+        self.arrays = {}
+        if self.is_complete():
+            self.load()
+
+    def __getstate__(self):
+        # memmaps are reopened lazily in DataLoader workers
+        state = self.__dict__.copy()
+        state['arrays'] = {}
+        return state
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def _chunk_path(self, file, chunk):
+        return self._path('{}.{:04d}.npy'.format(file, chunk))
+
+    def is_complete(self):
+        return os.path.exists(self._path('meta.json'))
+
+    @property
+    def n_variants(self):
+        return self.aug_table.shape[1]
+
+    @property
+    def chunk_size(self):
+        return self.config['chunk_size']
+
+    @property
+    def n_chunks(self):
+        return (self.config['n_data'] + self.chunk_size - 1) // self.chunk_size
+
+    @property
+    def formats(self):
+        return self.config['formats']
+
+    @property
+    def topk(self):
+        return {name: tuple(v) for name, v in self.config['topk'].items()}
+
+    def create(self, n_data, n_variants, formats, topk=None, chunk_size=5000, seed=0, **info):
+        '''
+        formats maps every output to store to one of CACHE_FORMATS, topk maps the
+        outputs stored as top-k logits to (k, T).
+        '''
+        for name, fmt in formats.items():
+            if fmt not in CACHE_FORMATS:
+                raise Exception('Invalid cache format {}...'.format(fmt))
+            if fmt == 'topk' and name not in (topk or {}):
+                raise Exception('Missing top-k setting of {}...'.format(name))
+        config = dict(info, n_data=n_data, n_variants=n_variants, formats=formats,
+                      topk=topk or {}, chunk_size=chunk_size, seed=seed)
+        config = json.loads(json.dumps(config))
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        if self.is_complete():
+            os.remove(self._path('meta.json'))
+
+        progress = None
+        if os.path.exists(self._path('progress.json')):
+            with open(self._path('progress.json')) as f:
+                progress = json.load(f)
+        if progress is not None and progress['config'] == config:
+            self.aug_table = np.load(self._path('aug.npy'))
+            self.layout = {f: (d, tuple(s)) for f, (d, s) in progress['layout'].items()}
+            self.chunks_done = progress['chunks_done']
+        else:
+            self.aug_table = make_aug_table(n_data, n_variants, seed=seed)
+            np.save(self._path('aug.npy'), self.aug_table)
+            self.layout = {}
+            self.chunks_done = 0
+        self.config = config
+        self.arrays = {}
+
+    def _save_progress(self):
+        layout = {f: (d, list(s)) for f, (d, s) in self.layout.items()}
+        with open(self._path('progress.json'), 'w') as f:
+            json.dump({'config': self.config, 'layout': layout, 'chunks_done': self.chunks_done}, f)
+
+    def encode(self, outputs):
+        '''
+        Converts a batch of teacher outputs into the stored files.
+        '''
+        encoded = {}
+        for name, fmt in self.formats.items():
+            out = outputs[name].detach().float()
+            if fmt == 'topk':
+                val, idx, lse = topk_logits(out, *self.topk[name])
+                encoded[name + '.val'] = val.half()
+                encoded[name + '.idx'] = idx.short() if out.size(1) <= np.iinfo(np.int16).max else idx.int()
+                encoded[name + '.lse'] = lse
+            elif fmt == 'int8':
+                if out.dim() > 2:
+                    scale = out.abs().amax(dim=tuple(range(2, out.dim())))
+                else:
+                    scale = out.abs().amax(dim=1, keepdim=True)
+                scale = scale.clamp(min=1e-8) / 127.0
+                q = out / scale.view(scale.shape + (1,) * (out.dim() - scale.dim()))
+                encoded[name] = q.round_().clamp_(-127, 127).to(torch.int8)
+                encoded[name + '.scale'] = scale
+            elif fmt == 'bf16':
+                encoded[name] = out.bfloat16().view(torch.int16)
+            else:
+                encoded[name] = out.half()
+        return {f: e.cpu().numpy() for f, e in encoded.items()}
+
+    def decode(self, cached, cuda=False):
+        '''
+        Converts a collated batch of read_sample() into {tap: output} of the cached
+        teacher outputs. Top-k outputs are returned as (val, idx, lse).
+        '''
+        if cuda:
+            cached = {f: c.cuda(non_blocking=True) for f, c in cached.items()}
+        outputs = {}
+        for name, fmt in self.formats.items():
+            if fmt == 'topk':
+                outputs[name] = (cached[name + '.val'].float(),
+                                 cached[name + '.idx'].long(),
+                                 cached[name + '.lse'])
+            elif fmt == 'int8':
+                q, scale = cached[name], cached[name + '.scale']
+                outputs[name] = q.float() * scale.view(scale.shape + (1,) * (q.dim() - scale.dim()))
+            elif fmt == 'bf16':
+                outputs[name] = cached[name].view(torch.bfloat16).float()
+            else:
+                outputs[name] = cached[name].float()
+        return outputs
+
+    def write_chunk(self, chunk, batches):
+        '''
+        batches yields (index, variant, encoded) for every sample of the chunk.
+        '''
+        start = chunk * self.chunk_size
+        n = min(self.chunk_size, self.config['n_data'] - start)
+        arrays = None
+        for index, variant, encoded in batches:
+            if arrays is None:
+                if not self.layout:
+                    self.layout = {f: (e.dtype.str, e.shape[1:]) for f, e in encoded.items()}
+                arrays = {f: np.lib.format.open_memmap(self._chunk_path(f, chunk), mode='w+', dtype=d,
+                                                       shape=(n, self.n_variants) + tuple(s))
+                          for f, (d, s) in self.layout.items()}
+            for f, arr in arrays.items():
+                arr[index - start, variant] = encoded[f]
+        for arr in arrays.values():
+            arr.flush()
+        self.chunks_done = chunk + 1
+        self._save_progress()
+
+    def finalize(self):
+        self._save_progress()
+        with open(self._path('meta.json'), 'w') as f:
+            json.dump({'config': self.config,
+                       'layout': {f: (d, list(s)) for f, (d, s) in self.layout.items()}}, f)
+        self.load()
+
+    def load(self):
+        with open(self._path('meta.json')) as f:
+            meta = json.load(f)
+        self.config = meta['config']
+        self.layout = {f: (d, tuple(s)) for f, (d, s) in meta['layout'].items()}
+        self.aug_table = np.load(self._path('aug.npy'))
+        self.chunks_done = self.n_chunks
+        self.arrays = {}
+
+    def check(self, n_data, formats, topk=None, **info):
+        topk = json.loads(json.dumps(topk or {}))
+        if self.config['n_data'] != n_data:
+            raise Exception('Teacher cache was built for {} samples, got {}...'.format(
+                self.config['n_data'], n_data))
+        for name, fmt in formats.items():
+            if self.formats.get(name) != fmt:
+                raise Exception('Teacher cache stores {} as {}, got {}...'.format(
+                    name, self.formats.get(name), fmt))
+            if self.config['topk'].get(name) != topk.get(name):
+                raise Exception('Teacher cache stores {} with top-k {}, got {}...'.format(
+                    name, self.config['topk'].get(name), topk.get(name)))
+        for k, v in info.items():
+            if self.config.get(k) != v:
+                raise Exception('Teacher cache was built with {}={}, got {}...'.format(
+                    k, self.config.get(k), v))
+
+    def nbytes(self):
+        return sum(os.path.getsize(self._chunk_path(f, c))
+                   for f in self.layout for c in range(self.chunks_done))
+
+    def _array(self, file, chunk):
+        key = (file, chunk)
+        if key not in self.arrays:
+            self.arrays[key] = np.load(self._chunk_path(file, chunk), mmap_mode='r')
+        return self.arrays[key]
+
+    def read_sample(self, index, variant):
+        chunk, offset = divmod(index, self.chunk_size)
+        return {f: torch.from_numpy(np.array(self._array(f, chunk)[offset, variant]))
+                for f in self.layout}
+
+
+def build_teacher_cache(tnet, dataset, cache, batch_size=256, cuda=True, num_workers=4):
+    '''
+    Runs the teacher over all (sample, variant) pairs of the chunks that are not
+    written yet. dataset is a ReplayAugDataset without an attached cache.
+    '''
+    def batches(loader):
+        for img, _, index, variant in loader:
+            if cuda:
+                img = img.cuda(non_blocking=True)
+            outputs = forward_taps(tnet, img, list(cache.formats))
+            yield index.numpy(), variant.numpy(), cache.encode(outputs)
+
+    tnet.eval()
+    with torch.no_grad():
+        for chunk in range(cache.chunks_done, cache.n_chunks):
+            start = chunk * cache.chunk_size
+            stop = min(start + cache.chunk_size, len(dataset))
+            pairs = [(i, v) for i in range(start, stop) for v in range(cache.n_variants)]
+            loader = DataLoader(dataset, batch_size=batch_size, sampler=pairs,
+                                num_workers=num_workers, pin_memory=True)
+            cache.write_chunk(chunk, batches(loader))
+    cache.finalize()
@@ -0,0 +1,55 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+import os
+import hashlib
+import torch
+
+'''
+Read-only teacher weights shared by every job on a host.
+
+The state dict of a teacher checkpoint is written once, without the 'module.' prefix
+of DataParallel, to a plain weights file in a shared directory (e.g. /dev/shm). Every
+job maps that file with torch.load(mmap=True) and assigns the mapped tensors to the
+teacher, which is built on the meta device, so no job allocates or copies its own
+copy of the parameters on the CPU. The file is private copy-on-write mapped and the
+frozen teacher never writes to it, so its pages stay shared in the page cache.
+'''
+
+
+def shared_weights_path(t_model, root):
+    # one file per teacher checkpoint, a new checkpoint at the same path gets a new file
+    st = os.stat(t_model)
+    key = '{}:{}:{}'.format(os.path.abspath(t_model), st.st_size, st.st_mtime_ns)
+    return os.path.join(root, 'teacher-{}.pt'.format(hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+
+def export_shared_weights(t_model, root):
+    '''
+    Writes the weights file of t_model to root unless it exists, returns its path.
+    Jobs starting at the same time may all write it, each writes a temporary file
+    and moves it into place, so readers only ever see a complete file.
+    '''
+    path = shared_weights_path(t_model, root)
+    if os.path.exists(path):
+        return path
+    if not os.path.exists(root):
+        os.makedirs(root)
+    state = torch.load(t_model, map_location='cpu')['net']
+    state = {(k[len('module.'):] if k.startswith('module.') else k): v.contiguous() for k, v in state.items()}
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_shared_weights(net, t_model, root):
+    '''
+    Maps the shared weights of t_model into net (built on the meta device, not
+    wrapped in DataParallel). Every parameter and buffer of net must be in the
+    checkpoint. Returns the path of the weights file.
+    '''
+    path = export_shared_weights(t_model, root)
+    state = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    net.load_state_dict(state, assign=True)
+    return path
@@ -2,51 +2,45 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 import os
-import sys
-import time
+import copy
 import logging
-import argparse
-import numpy as np
 from itertools import chain
+from collections import OrderedDict
 
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
-import torch.backends.cudnn as cudnn
-import torchvision.transforms as transforms
-import torchvision.datasets as dst
-
-from utils import AverageMeter, accuracy, transform_time, define_tsnet
-from utils import load_pretrained_model, save_checkpoint
-from utils import create_exp_dir, count_parameters_in_MB
-from kd_losses import *
-
-parser = argparse.ArgumentParser(description='train kd')
-
-# various path
-parser.add_argument('--save_root', type=str, default='./results', help='models and logs are saved here')
-parser.add_argument('--img_root', type=str, default='/home/lab265/lab265/datasets', help='path name of image dataset')
-parser.add_argument('--s_init', type=str, required=True, help='initial parameters of student model')
-parser.add_argument('--t_model', type=str, required=True, help='path name of teacher model')
-
-# training hyper parameters
-parser.add_argument('--print_freq', type=int, default=50, help='frequency of showing training results on console')
-parser.add_argument('--epochs', type=int, default=200, help='number of total epochs to run')
-parser.add_argument('--batch_size', type=int, default=128, help='The size of batch')
-parser.add_argument('--lr', type=float, default=0.1, help='initial learning rate')
-parser.add_argument('--momentum', type=float, default=0.9, help='momentum')
-parser.add_argument('--weight_decay', type=float, default=1e-4, help='weight decay')
-parser.add_argument('--num_class', type=int, default=10, help='number of classes')
-parser.add_argument('--cuda', type=int, default=1)
-
-# others
-parser.add_argument('--seed', type=int, default=2, help='random seed')
-parser.add_argument('--note', type=str, default='try', help='note for this run')
-
-# net and dataset choose
-parser.add_argument('--data_name', type=str, required=True, help='name of dataset')  # CIFAR10 / CIFAR100
-parser.add_argument('--t_name', type=str, required=True, help='name of teacher')
-parser.add_argument('--s_name', type=str, required=True, help='name of student')
+
+from engine import get_parser, setup, load_net, tap_channels, sgd, set_lr
+from engine import get_dataset, raw_dataset, get_loaders, fit, run_stage, cls_stats
+from engine import KD_MODES, get_taps, forward_taps, teacher_grad, Teacher, log_teacher_memory
+from engine import TeacherPrefetcher, distributed, ddp, train_epoch, test_epoch, format_meters
+from utils import define_tsnet, create_exp_dir, save_checkpoint
+from sweep import parse_sweep, sweep_name, StudentStack
+from teacher_cache import TeacherCache, ReplayAugDataset, ReplayAugSampler, build_teacher_cache, CACHE_TAPS
+from kd_losses.st import SparseSoftTarget, topk_logits
+from kd_losses.relations import relation_cache
+
+parser = get_parser('train kd')
+parser.set_defaults(img_root='/home/lab265/lab265/datasets')
+
+# teacher cache
+parser.add_argument('--teacher_cache', type=str, default='', help='dir of the offline teacher output cache, built '
+                                                                  'on first use (logits/st/fitnet/nst/at/sp/ab/fsp)')
+parser.add_argument('--cache_variants', type=int, default=8, help='number of cached augmentations per sample')
+parser.add_argument('--cache_dtype', type=str, default='fp16', choices=['fp16', 'bf16', 'int8'],
+                    help='storage type of the cached teacher outputs')
+parser.add_argument('--cache_chunk', type=int, default=5000, help='number of samples per teacher cache file')
+parser.add_argument('--cache_topk', type=int, default=0, help='only cache the top-k teacher logits (only for st), '
+                                                              '0 caches dense logits')
+
+# teacher pipeline
+parser.add_argument('--teacher_threads', type=int, default=0, help='run the teacher on a separate thread with this '
+                                                                   'many intra-op threads, 0 runs it in the step')
+parser.add_argument('--prefetch', type=int, default=2, help='number of batches the teacher thread runs ahead')
+
+# sweep
+parser.add_argument('--sweep', type=str, nargs='*', default=[], help='train one student per point of the grid '
+                                                                     'against one teacher, e.g. lambda_kd=0.1,1 T=2,4')
+parser.add_argument('--sweep_vmap', type=int, default=1, help='vectorize the student forwards of a sweep')
 
 # hyper parameter
 parser.add_argument('--kd_mode', type=str, required=True, help='mode of kd, which can be:'
@@ -55,11 +49,22 @@ parser.add_argument('--kd_mode', type=str, required=True, help='mode of kd, whic
 parser.add_argument('--lambda_kd', type=float, default=1.0, help='trade-off parameter for kd loss')
 parser.add_argument('--T', type=float, default=4.0, help='temperature for ST')
 parser.add_argument('--p', type=float, default=2.0, help='power for AT')
+parser.add_argument('--nst_gram', type=str, default='auto', choices=['auto', 'spatial', 'channel', 'full'],
+                    help='form of the NST kernel: HW x HW or C x C Gram matrices, the smaller one, or the original')
+parser.add_argument('--nst_channels', type=int, default=0, help='estimate the NST kernel on this many sampled '
+                                                                'channels, 0 uses all')
 parser.add_argument('--w_dist', type=float, default=25.0, help='weight for RKD distance')
 parser.add_argument('--w_angle', type=float, default=50.0, help='weight for RKD angle')
+parser.add_argument('--rkd_angle', type=str, default='gram', choices=['full', 'gram', 'sample'],
+                    help='RKD angle from the N x N x C differences, the tiled Gram matrix or sampled triplets')
+parser.add_argument('--rkd_budget', type=float, default=64, help='memory budget (MB) of a tile of the RKD angle')
+parser.add_argument('--rkd_triplets', type=int, default=4096, help='number of sampled triplets of the RKD angle')
+parser.add_argument('--pkt_block', type=int, default=0, help='rows per block of PKT, 0 for the full matrices')
 parser.add_argument('--m', type=float, default=2.0, help='margin for AB')
 parser.add_argument('--gamma', type=float, default=0.4, help='gamma in Gaussian RBF for CC')
 parser.add_argument('--P_order', type=int, default=2, help='P-order Taylor series of Gaussian RBF for CC')
+parser.add_argument('--cc_kernel', type=str, default='taylor', choices=['taylor', 'exact'],
+                    help='Taylor series or exact Gaussian RBF for CC')
 parser.add_argument('--w_irg_vert', type=float, default=0.1, help='weight for IRG vertex')
 parser.add_argument('--w_irg_edge', type=float, default=5.0, help='weight for IRG edge')
 parser.add_argument('--w_irg_tran', type=float, default=5.0, help='weight for IRG transformation')
@@ -68,492 +73,294 @@ parser.add_argument('--init_var', type=float, default=5.0, help='initial varianc
 parser.add_argument('--att_f', type=float, default=1.0, help='attention factor of mid_channels for AFD')
 
 args, unparsed = parser.parse_known_args()
-
-args.save_root = os.path.join(args.save_root, args.note)
-create_exp_dir(args.save_root)
-
-log_format = '%(message)s'
-logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=log_format)
-fh = logging.FileHandler(os.path.join(args.save_root, 'log.txt'))
-fh.setFormatter(logging.Formatter(log_format))
-logging.getLogger().addHandler(fh)
+setup(args, unparsed)
 
 
 def main():
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    if args.cuda:
-        torch.cuda.manual_seed(args.seed)
-        cudnn.enabled = True
-        cudnn.benchmark = True
-    logging.info("args = %s", args)
-    logging.info("unparsed_args = %s", unparsed)
-
     logging.info('----------- Network Initialization --------------')
-    snet = define_tsnet(name=args.s_name, num_class=args.num_class, cuda=args.cuda)  # initialize student net
-    checkpoint = torch.load(args.s_init)
-    load_pretrained_model(snet, checkpoint['net'])
-    logging.info('Student: %s', snet)
-    logging.info('Student param size = %fMB', count_parameters_in_MB(snet))
-
-    tnet = define_tsnet(name=args.t_name, num_class=args.num_class, cuda=args.cuda)  # initialize teacher net
-    checkpoint = torch.load(args.t_model)
-    load_pretrained_model(tnet, checkpoint['net'])
-    tnet.eval()
-    for param in tnet.parameters():
-        param.requires_grad = False
-    logging.info('Teacher: %s', tnet)
-    logging.info('Teacher param size = %fMB', count_parameters_in_MB(tnet))
+    snet = load_net('Student', args.s_name, args.num_class, args.cuda, args.s_init)
+    tnet = load_net('Teacher', args.t_name, args.num_class, args.cuda, args.t_model, frozen=True,
+                    shared=args.t_shared)
     logging.info('-----------------------------------------------')
 
     # define loss functions
-    if args.kd_mode == 'logits':
-        criterionKD = Logits()
-    elif args.kd_mode == 'st':
-        criterionKD = SoftTarget(args.T)
-    elif args.kd_mode == 'at':
-        criterionKD = AT(args.p)
-    elif args.kd_mode == 'fitnet':
-        criterionKD = Hint()
-    elif args.kd_mode == 'nst':
-        criterionKD = NST()
-    elif args.kd_mode == 'pkt':
-        criterionKD = PKTCosSim()
-    elif args.kd_mode == 'fsp':
-        criterionKD = FSP()
-    elif args.kd_mode == 'rkd':
-        criterionKD = RKD(args.w_dist, args.w_angle)
-    elif args.kd_mode == 'ab':
-        criterionKD = AB(args.m)
-    elif args.kd_mode == 'sp':
-        criterionKD = SP()
-    elif args.kd_mode == 'sobolev':
-        criterionKD = Sobolev()
-    elif args.kd_mode == 'cc':
-        criterionKD = CC(args.gamma, args.P_order)
-    elif args.kd_mode == 'lwm':
-        criterionKD = LwM()
-    elif args.kd_mode == 'irg':
-        criterionKD = IRG(args.w_irg_vert, args.w_irg_edge, args.w_irg_tran)
-    elif args.kd_mode == 'vid':
-        s_channels = snet.module.get_channel_num()[1:4]
-        t_channels = tnet.module.get_channel_num()[1:4]
-        criterionKD = []
-        for s_c, t_c in zip(s_channels, t_channels):
-            criterionKD.append(VID(s_c, int(args.sf * t_c), t_c, args.init_var))
-        criterionKD = [c.cuda() for c in criterionKD] if args.cuda else criterionKD
-        criterionKD = [None] + criterionKD  # None is a placeholder
-    elif args.kd_mode == 'ofd':
-        s_channels = snet.module.get_channel_num()[1:4]
-        t_channels = tnet.module.get_channel_num()[1:4]
-        criterionKD = []
-        for s_c, t_c in zip(s_channels, t_channels):
-            criterionKD.append(OFD(s_c, t_c).cuda() if args.cuda else OFD(s_c, t_c))
-        criterionKD = [None] + criterionKD  # None is a placeholder
-    elif args.kd_mode == 'afd':
-        # t_channels is same with s_channels
-        s_channels = snet.module.get_channel_num()[1:4]
-        t_channels = tnet.module.get_channel_num()[1:4]
-        criterionKD = []
-        for t_c in t_channels:
-            criterionKD.append(AFD(t_c, args.att_f).cuda() if args.cuda else AFD(t_c, args.att_f))
-        criterionKD = [None] + criterionKD  # None is a placeholder
-    else:
+    if args.kd_mode not in KD_MODES:
         raise Exception('Invalid kd mode...')
-
-    if args.cuda:
-        criterionCls = torch.nn.CrossEntropyLoss().cuda()
-    else:
-        criterionCls = torch.nn.CrossEntropyLoss()
-
-    # initialize optimizer
-    if args.kd_mode in ['vid', 'ofd', 'afd']:
-        optimizer = torch.optim.SGD(chain(snet.parameters(),
-                                          *[c.parameters() for c in criterionKD[1:]]),
-                                    lr=args.lr,
-                                    momentum=args.momentum,
-                                    weight_decay=args.weight_decay,
-                                    nesterov=True)
+    if args.kd_mode == 'st' and args.teacher_cache and args.cache_topk > 0:
+        criterionKD = SparseSoftTarget(args.T)
     else:
-        optimizer = torch.optim.SGD(snet.parameters(),
-                                    lr=args.lr,
-                                    momentum=args.momentum,
-                                    weight_decay=args.weight_decay,
-                                    nesterov=True)
+        criterionKD = KD_MODES[args.kd_mode].build(args, tap_channels(snet), tap_channels(tnet))
+    apply_kd = KD_MODES[args.kd_mode].apply
+    criterionCls = torch.nn.CrossEntropyLoss()
+    if args.cuda:
+        criterionKD = criterionKD.cuda()
+        criterionCls = criterionCls.cuda()
+    criterionKD = ddp(criterionKD)
+
+    # initialize optimizer, vid/ofd/afd also train their criterions
+    optimizer = sgd(args, chain(snet.parameters(), criterionKD.parameters()))
 
     # initialize scheduler
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.epochs)
 
-    # define transforms
-    if args.data_name == 'CIFAR10':
-        dataset = dst.CIFAR10
-        mean = (0.4914, 0.4822, 0.4465)
-        std = (0.2470, 0.2435, 0.2616)
-    elif args.data_name == 'CIFAR100':
-        dataset = dst.CIFAR100
-        mean = (0.5071, 0.4865, 0.4409)
-        std = (0.2673, 0.2564, 0.2762)
+    # define data loader
+    tcache = None
+    if args.teacher_cache:
+        if distributed():
+            raise Exception('The teacher cache does not support distributed training...')
+        if args.kd_mode not in CACHE_TAPS:
+            raise Exception('Teacher cache does not support {}...'.format(args.kd_mode))
+        if args.cache_topk > 0 and args.kd_mode != 'st':
+            raise Exception('Top-k teacher cache only supports st...')
+        cache_formats = {name: args.cache_dtype for name in CACHE_TAPS[args.kd_mode]}
+        cache_topk = {}
+        if args.cache_topk > 0:
+            cache_formats['out'] = 'topk'
+            cache_topk['out'] = (args.cache_topk, args.T)
+        cache_info = {'t_model': os.path.abspath(args.t_model), 'data_name': args.data_name}
+        _, mean, std = get_dataset(args)
+
+        train_set = raw_dataset(args, train=True)
+        tcache = TeacherCache(args.teacher_cache)
+        if tcache.is_complete():
+            tcache.check(len(train_set), cache_formats, topk=cache_topk, **cache_info)
+            train_set = ReplayAugDataset(train_set, tcache.aug_table, mean, std)
+        else:
+            tcache.create(len(train_set), args.cache_variants, cache_formats, topk=cache_topk,
+                          chunk_size=args.cache_chunk, seed=args.seed, **cache_info)
+            logging.info('Building teacher cache in %s from chunk %d/%d......',
+                         args.teacher_cache, tcache.chunks_done, tcache.n_chunks)
+            train_set = ReplayAugDataset(train_set, tcache.aug_table, mean, std)
+            build_teacher_cache(tnet, train_set, tcache, cuda=args.cuda)
+        train_set.cache = tcache
+        logging.info('Teacher cache: %d variants, %fMB', tcache.n_variants, tcache.nbytes() / 1e6)
+        train_loader, test_loader = get_loaders(args, train_set,
+                                                sampler=ReplayAugSampler(len(train_set), tcache.n_variants))
     else:
-        raise Exception('Invalid dataset name...')
-
-    train_transform = transforms.Compose([
-        transforms.Pad(4, padding_mode='reflect'),
-        transforms.RandomCrop(32),
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=mean, std=std)
-    ])
-    test_transform = transforms.Compose([
-        transforms.CenterCrop(32),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=mean, std=std)
-    ])
+        train_loader, test_loader = get_loaders(args)
+
+    taps = get_taps(criterionKD)
+    s_taps = taps if 'out' in taps else taps + ['out']
+    t_grad = teacher_grad(criterionKD)
+    sparse = isinstance(criterionKD, SparseSoftTarget)
+    teacher = Teacher(tnet, taps, t_grad)
+    if args.cuda and tcache is None:
+        log_teacher_memory(teacher, torch.randn(args.batch_size, 3, 32, 32).cuda(), args.kd_mode)
+
+    # the teacher outputs of the next batches are computed while the student trains
+    prefetch = args.teacher_threads > 0
+    if prefetch:
+        if tcache is not None or t_grad:
+            raise Exception('The teacher pipeline does not support sobolev/lwm or the teacher cache...')
+        torch.set_num_threads(max(1, torch.get_num_threads() - args.teacher_threads))
+        train_loader = TeacherPrefetcher(train_loader, teacher, args.prefetch, args.teacher_threads, args.cuda)
+        test_loader = TeacherPrefetcher(test_loader, teacher, args.prefetch, args.teacher_threads, args.cuda)
+
+    def kd_step(init=False):
+        def step(batch, epoch):
+            img, target = batch[:2]
+            if t_grad:
+                img.requires_grad = True
+
+            s = forward_taps(snet, img, s_taps)
+            if prefetch:
+                t = batch[2]
+            elif len(batch) > 2:
+                t = tcache.decode(batch[2], args.cuda)
+            else:
+                t = teacher(img)
+                if sparse:
+                    t['out'] = topk_logits(t['out'], args.cache_topk, args.T)
+
+            cls_loss = criterionCls(s['out'], target)
+            if init:
+                cls_loss = cls_loss * 0.0
+            # relation matrices (kd_losses/relations.py) are shared by the terms of the loss
+            with relation_cache():
+                kd_loss = apply_kd(criterionKD, s, t, taps, img=img, target=target) * args.lambda_kd
+            loss = cls_loss + kd_loss
 
-    # define data loader
-    root_path = os.path.join(args.img_root, args.data_name)
-    train_loader = torch.utils.data.DataLoader(
-        dataset(root=root_path,
-                transform=train_transform,
-                train=True,
-                download=True),
-        batch_size=args.batch_size, shuffle=True, num_workers=4, pin_memory=True)
-    test_loader = torch.utils.data.DataLoader(
-        dataset(root=root_path,
-                transform=test_transform,
-                train=False,
-                download=True),
-        batch_size=args.batch_size, shuffle=False, num_workers=4, pin_memory=True)
-
-    # warp nets and criterions for train and test
-    nets = {'snet': snet, 'tnet': tnet}
-    criterions = {'criterionCls': criterionCls, 'criterionKD': criterionKD}
+            stats = OrderedDict([('Cls', cls_loss), ('KD', kd_loss)])
+            return loss, cls_stats(stats, s['out'], target)
+        return step
+
+    modules = [snet, criterionKD]
 
     # first init the student nets
     if args.kd_mode in ['fsp', 'ab']:
         logging.info('The first stage, student initialization......')
-        train_init(train_loader, nets, optimizer, criterions, 50)
+        run_stage(args, train_loader, kd_step(init=True), [optimizer], 50,
+                  lambda epoch: adjust_lr_init(optimizer, epoch), modules)
         args.lambda_kd = 0.0
         logging.info('The second stage, softmax training......')
 
-    best_top1 = 0
-    best_top5 = 0
-
-    for epoch in range(1, args.epochs + 1):
-        # adjust_lr(optimizer, epoch)
-        current_lr = optimizer.state_dict()['param_groups'][0]['lr']
-        print(f'current_lr：{current_lr}')
-
-        # train one epoch
-        epoch_start_time = time.time()
-        train(train_loader, nets, optimizer, criterions, epoch)
-
-        # evaluate on testing set
-        logging.info('Testing the models......')
-        test_top1, test_top5 = test(test_loader, nets, criterions, epoch)
-
-        epoch_duration = time.time() - epoch_start_time
-        logging.info('Epoch time: {}s'.format(int(epoch_duration)))
-
-        scheduler.step()
-
-        # save model
-        is_best = False
-        if test_top1 > best_top1:
-            best_top1 = test_top1
-            best_top5 = test_top5
-            is_best = True
-        logging.info('Saving models......')
-        save_checkpoint({
+    def checkpoint(epoch, meters, best):
+        return {
             'epoch': epoch,
             'snet': snet.state_dict(),
             'tnet': tnet.state_dict(),
-            'prec@1': test_top1,
-            'prec@5': test_top5,
-        }, is_best, args.save_root)
-
-
-def train_init(train_loader, nets, optimizer, criterions, total_epoch):
-    snet = nets['snet']
-    tnet = nets['tnet']
-
-    criterionCls = criterions['criterionCls']
-    criterionKD = criterions['criterionKD']
-
-    # student net train
-    snet.train()
-
-    for epoch in range(1, total_epoch + 1):
-        adjust_lr_init(optimizer, epoch)
-
-        batch_time = AverageMeter()
-        data_time = AverageMeter()
-        cls_losses = AverageMeter()
-        kd_losses = AverageMeter()
-        top1 = AverageMeter()
-        top5 = AverageMeter()
-
-        epoch_start_time = time.time()
-        end = time.time()
-        for i, (img, target) in enumerate(train_loader, start=1):
-            data_time.update(time.time() - end)
-
-            if args.cuda:
-                img = img.cuda(non_blocking=True)
-                target = target.cuda(non_blocking=True)
-
-            stem_s, rb1_s, rb2_s, rb3_s, feat_s, out_s = snet(img)
-            stem_t, rb1_t, rb2_t, rb3_t, feat_t, out_t = tnet(img)
-
-            cls_loss = criterionCls(out_s, target) * 0.0
-            if args.kd_mode in ['fsp']:
-                kd_loss = (criterionKD(stem_s[1], rb1_s[1], stem_t[1].detach(), rb1_t[1].detach()) +
-                           criterionKD(rb1_s[1], rb2_s[1], rb1_t[1].detach(), rb2_t[1].detach()) +
-                           criterionKD(rb2_s[1], rb3_s[1], rb2_t[1].detach(), rb3_t[1].detach())) / 3.0 * args.lambda_kd
-            elif args.kd_mode in ['ab']:
-                kd_loss = (criterionKD(rb1_s[0], rb1_t[0].detach()) +
-                           criterionKD(rb2_s[0], rb2_t[0].detach()) +
-                           criterionKD(rb3_s[0], rb3_t[0].detach())) / 3.0 * args.lambda_kd
-            else:
-                raise Exception('Invalid kd mode...')
-            loss = cls_loss + kd_loss
+            'prec@1': meters['prec@1'].avg,
+            'prec@5': meters['prec@5'].avg,
+        }
+
+    fit(args, train_loader, test_loader, kd_step(), kd_step(), [optimizer], checkpoint,
+        modules=modules, scheduler=scheduler, test_grad=t_grad)
+
+
+def sweep_main():
+    '''
+    One student per point of the --sweep grid, all trained against one teacher forward
+    per batch. Every student has its own args, criterion, optimizer, scheduler and a
+    sub dir of save_root with its checkpoints and log; the main log meters all of
+    them, the stats of student k are suffixed with k.
+    '''
+    if args.kd_mode not in KD_MODES:
+        raise Exception('Invalid kd mode...')
+    if args.teacher_cache or distributed():
+        raise Exception('A sweep does not support the teacher cache or distributed training...')
+    settings = parse_sweep(args, args.sweep)
+    sweep_args = []
+    for setting in settings:
+        s_args = copy.copy(args)
+        vars(s_args).update(setting)
+        s_args.save_root = os.path.join(args.save_root, sweep_name(setting))
+        sweep_args.append(s_args)
 
-            prec1, prec5 = accuracy(out_s, target, topk=(1, 5))
-            cls_losses.update(cls_loss.item(), img.size(0))
-            kd_losses.update(kd_loss.item(), img.size(0))
-            top1.update(prec1.item(), img.size(0))
-            top5.update(prec5.item(), img.size(0))
-
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            batch_time.update(time.time() - end)
-            end = time.time()
-
-            if i % args.print_freq == 0:
-                log_str = ('Epoch[{0}]:[{1:03}/{2:03}] '
-                           'Time:{batch_time.val:.4f} '
-                           'Data:{data_time.val:.4f}  '
-                           'Cls:{cls_losses.val:.4f}({cls_losses.avg:.4f})  '
-                           'KD:{kd_losses.val:.4f}({kd_losses.avg:.4f})  '
-                           'prec@1:{top1.val:.2f}({top1.avg:.2f})  '
-                           'prec@5:{top5.val:.2f}({top5.avg:.2f})'.format(
-                    epoch, i, len(train_loader), batch_time=batch_time, data_time=data_time,
-                    cls_losses=cls_losses, kd_losses=kd_losses, top1=top1, top5=top5))
-                logging.info(log_str)
-
-        epoch_duration = time.time() - epoch_start_time
-        logging.info('Epoch time: {}s'.format(int(epoch_duration)))
-
-
-def train(train_loader, nets, optimizer, criterions, epoch):
-    batch_time = AverageMeter()
-    data_time = AverageMeter()
-    cls_losses = AverageMeter()
-    kd_losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
-
-    snet = nets['snet']
-    tnet = nets['tnet']
-
-    criterionCls = criterions['criterionCls']
-    criterionKD = criterions['criterionKD']
-
-    snet.train()
-    if args.kd_mode in ['vid', 'ofd']:
-        for i in range(1, 4):
-            criterionKD[i].train()
-
-    end = time.time()
-    for i, (img, target) in enumerate(train_loader, start=1):
-        data_time.update(time.time() - end)
+    logging.info('----------- Network Initialization --------------')
+    snets = [load_net('Student{}'.format(k), args.s_name, args.num_class, args.cuda, args.s_init)
+             for k in range(len(settings))]
+    tnet = load_net('Teacher', args.t_name, args.num_class, args.cuda, args.t_model, frozen=True,
+                    shared=args.t_shared)
+    with torch.device('meta'):
+        base = define_tsnet(args.s_name, args.num_class, cuda=False, return_features=False, parallel=None)
+    students = StudentStack(snets, base, vectorize=args.sweep_vmap)
+    logging.info('-----------------------------------------------')
 
+    apply_kd = KD_MODES[args.kd_mode].apply
+    criterionCls = torch.nn.CrossEntropyLoss()
+    criteria, optimizers, schedulers, loggers = [], [], [], []
+    for k, (setting, s_args, snet) in enumerate(zip(settings, sweep_args, snets)):
+        criterionKD = KD_MODES[args.kd_mode].build(s_args, tap_channels(snet), tap_channels(tnet))
         if args.cuda:
-            img = img.cuda(non_blocking=True)
-            target = target.cuda(non_blocking=True)
-
-        if args.kd_mode in ['sobolev', 'lwm']:
-            img.requires_grad = True
-
-        stem_s, rb1_s, rb2_s, rb3_s, feat_s, out_s = snet(img)
-        stem_t, rb1_t, rb2_t, rb3_t, feat_t, out_t = tnet(img)
-
-        cls_loss = criterionCls(out_s, target)
-
-        if args.kd_mode in ['logits', 'st']:
-            kd_loss = criterionKD(out_s, out_t.detach()) * args.lambda_kd
-        elif args.kd_mode in ['fitnet', 'nst']:
-            kd_loss = criterionKD(rb3_s[1], rb3_t[1].detach()) * args.lambda_kd
-        elif args.kd_mode in ['at', 'sp']:
-            kd_loss = (criterionKD(rb1_s[1], rb1_t[1].detach()) +
-                       criterionKD(rb2_s[1], rb2_t[1].detach()) +
-                       criterionKD(rb3_s[1], rb3_t[1].detach())) / 3.0 * args.lambda_kd
-        elif args.kd_mode in ['pkt', 'rkd', 'cc']:
-            kd_loss = criterionKD(feat_s, feat_t.detach()) * args.lambda_kd
-        elif args.kd_mode in ['fsp']:
-            kd_loss = (criterionKD(stem_s[1], rb1_s[1], stem_t[1].detach(), rb1_t[1].detach()) +
-                       criterionKD(rb1_s[1], rb2_s[1], rb1_t[1].detach(), rb2_t[1].detach()) +
-                       criterionKD(rb2_s[1], rb3_s[1], rb2_t[1].detach(), rb3_t[1].detach())) / 3.0 * args.lambda_kd
-        elif args.kd_mode in ['ab']:
-            kd_loss = (criterionKD(rb1_s[0], rb1_t[0].detach()) +
-                       criterionKD(rb2_s[0], rb2_t[0].detach()) +
-                       criterionKD(rb3_s[0], rb3_t[0].detach())) / 3.0 * args.lambda_kd
-        elif args.kd_mode in ['sobolev']:
-            kd_loss = criterionKD(out_s, out_t, img, target) * args.lambda_kd
-        elif args.kd_mode in ['lwm']:
-            kd_loss = criterionKD(out_s, rb2_s[1], out_t, rb2_t[1], target) * args.lambda_kd
-        elif args.kd_mode in ['irg']:
-            kd_loss = criterionKD([rb2_s[1], rb3_s[1], feat_s, out_s],
-                                  [rb2_t[1].detach(),
-                                   rb3_t[1].detach(),
-                                   feat_t.detach(),
-                                   out_t.detach()]) * args.lambda_kd
-        elif args.kd_mode in ['vid', 'afd']:
-            kd_loss = (criterionKD[1](rb1_s[1], rb1_t[1].detach()) +
-                       criterionKD[2](rb2_s[1], rb2_t[1].detach()) +
-                       criterionKD[3](rb3_s[1], rb3_t[1].detach())) / 3.0 * args.lambda_kd
-        elif args.kd_mode in ['ofd']:
-            kd_loss = (criterionKD[1](rb1_s[0], rb1_t[0].detach()) +
-                       criterionKD[2](rb2_s[0], rb2_t[0].detach()) +
-                       criterionKD[3](rb3_s[0], rb3_t[0].detach())) / 3.0 * args.lambda_kd
-        else:
-            raise Exception('Invalid kd mode...')
-        loss = cls_loss + kd_loss
-
-        prec1, prec5 = accuracy(out_s, target, topk=(1, 5))
-        cls_losses.update(cls_loss.item(), img.size(0))
-        kd_losses.update(kd_loss.item(), img.size(0))
-        top1.update(prec1.item(), img.size(0))
-        top5.update(prec5.item(), img.size(0))
-
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-        batch_time.update(time.time() - end)
-        end = time.time()
-
-        if i % args.print_freq == 0:
-            log_str = ('Epoch[{0}]:[{1:03}/{2:03}] '
-                       'Time:{batch_time.val:.4f} '
-                       'Data:{data_time.val:.4f}  '
-                       'Cls:{cls_losses.val:.4f}({cls_losses.avg:.4f})  '
-                       'KD:{kd_losses.val:.4f}({kd_losses.avg:.4f})  '
-                       'prec@1:{top1.val:.2f}({top1.avg:.2f})  '
-                       'prec@5:{top5.val:.2f}({top5.avg:.2f})'.format(
-                epoch, i, len(train_loader), batch_time=batch_time, data_time=data_time,
-                cls_losses=cls_losses, kd_losses=kd_losses, top1=top1, top5=top5))
-            logging.info(log_str)
-
-
-def test(test_loader, nets, criterions, epoch):
-    cls_losses = AverageMeter()
-    kd_losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
-
-    snet = nets['snet']
-    tnet = nets['tnet']
-
-    criterionCls = criterions['criterionCls']
-    criterionKD = criterions['criterionKD']
-
-    snet.eval()
-    if args.kd_mode in ['vid', 'ofd']:
-        for i in range(1, 4):
-            criterionKD[i].eval()
-
-    end = time.time()
-    for i, (img, target) in enumerate(test_loader, start=1):
-        if args.cuda:
-            img = img.cuda(non_blocking=True)
-            target = target.cuda(non_blocking=True)
-
-        if args.kd_mode in ['sobolev', 'lwm']:
-            img.requires_grad = True
-            stem_s, rb1_s, rb2_s, rb3_s, feat_s, out_s = snet(img)
-            stem_t, rb1_t, rb2_t, rb3_t, feat_t, out_t = tnet(img)
-        else:
-            with torch.no_grad():
-                stem_s, rb1_s, rb2_s, rb3_s, feat_s, out_s = snet(img)
-                stem_t, rb1_t, rb2_t, rb3_t, feat_t, out_t = tnet(img)
-
-        cls_loss = criterionCls(out_s, target)
-        if args.kd_mode in ['logits', 'st']:
-            kd_loss = criterionKD(out_s, out_t.detach()) * args.lambda_kd
-        elif args.kd_mode in ['fitnet', 'nst']:
-            kd_loss = criterionKD(rb3_s[1], rb3_t[1].detach()) * args.lambda_kd
-        elif args.kd_mode in ['at', 'sp']:
-            kd_loss = (criterionKD(rb1_s[1], rb1_t[1].detach()) +
-                       criterionKD(rb2_s[1], rb2_t[1].detach()) +
-                       criterionKD(rb3_s[1], rb3_t[1].detach())) / 3.0 * args.lambda_kd
-        elif args.kd_mode in ['pkt', 'rkd', 'cc']:
-            kd_loss = criterionKD(feat_s, feat_t.detach()) * args.lambda_kd
-        elif args.kd_mode in ['fsp']:
-            kd_loss = (criterionKD(stem_s[1], rb1_s[1], stem_t[1].detach(), rb1_t[1].detach()) +
-                       criterionKD(rb1_s[1], rb2_s[1], rb1_t[1].detach(), rb2_t[1].detach()) +
-                       criterionKD(rb2_s[1], rb3_s[1], rb2_t[1].detach(), rb3_t[1].detach())) / 3.0 * args.lambda_kd
-        elif args.kd_mode in ['ab']:
-            kd_loss = (criterionKD(rb1_s[0], rb1_t[0].detach()) +
-                       criterionKD(rb2_s[0], rb2_t[0].detach()) +
-                       criterionKD(rb3_s[0], rb3_t[0].detach())) / 3.0 * args.lambda_kd
-        elif args.kd_mode in ['sobolev']:
-            kd_loss = criterionKD(out_s, out_t, img, target) * args.lambda_kd
-        elif args.kd_mode in ['lwm']:
-            kd_loss = criterionKD(out_s, rb2_s[1], out_t, rb2_t[1], target) * args.lambda_kd
-        elif args.kd_mode in ['irg']:
-            kd_loss = criterionKD([rb2_s[1], rb3_s[1], feat_s, out_s],
-                                  [rb2_t[1].detach(),
-                                   rb3_t[1].detach(),
-                                   feat_t.detach(),
-                                   out_t.detach()]) * args.lambda_kd
-        elif args.kd_mode in ['vid', 'afd']:
-            kd_loss = (criterionKD[1](rb1_s[1], rb1_t[1].detach()) +
-                       criterionKD[2](rb2_s[1], rb2_t[1].detach()) +
-                       criterionKD[3](rb3_s[1], rb3_t[1].detach())) / 3.0 * args.lambda_kd
-        elif args.kd_mode in ['ofd']:
-            kd_loss = (criterionKD[1](rb1_s[0], rb1_t[0].detach()) +
-                       criterionKD[2](rb2_s[0], rb2_t[0].detach()) +
-                       criterionKD[3](rb3_s[0], rb3_t[0].detach())) / 3.0 * args.lambda_kd
-        else:
-            raise Exception('Invalid kd mode...')
-
-        prec1, prec5 = accuracy(out_s, target, topk=(1, 5))
-        cls_losses.update(cls_loss.item(), img.size(0))
-        kd_losses.update(kd_loss.item(), img.size(0))
-        top1.update(prec1.item(), img.size(0))
-        top5.update(prec5.item(), img.size(0))
+            criterionKD = criterionKD.cuda()
+        optimizer = sgd(s_args, chain(snet.parameters(), criterionKD.parameters()))
+        criteria.append(criterionKD)
+        optimizers.append(optimizer)
+        schedulers.append(torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.epochs))
+
+        create_exp_dir(s_args.save_root)
+        s_logger = logging.getLogger('sweep.{}'.format(k))
+        s_logger.propagate = False
+        s_logger.addHandler(logging.FileHandler(os.path.join(s_args.save_root, 'log.txt')))
+        s_logger.info('student %d: %s', k, sweep_name(setting))
+        s_logger.info('args = %s', s_args)
+        loggers.append(s_logger)
+        logging.info('Student%d: %s', k, sweep_name(setting))
+    if args.cuda:
+        criterionCls = criterionCls.cuda()
+
+    train_loader, test_loader = get_loaders(args)
+
+    taps = get_taps(criteria[0])
+    s_taps = taps if 'out' in taps else taps + ['out']
+    t_grad = teacher_grad(criteria[0])
+    teacher = Teacher(tnet, taps, t_grad)
+
+    prefetch = args.teacher_threads > 0
+    if prefetch:
+        if t_grad:
+            raise Exception('The teacher pipeline does not support sobolev/lwm...')
+        torch.set_num_threads(max(1, torch.get_num_threads() - args.teacher_threads))
+        train_loader = TeacherPrefetcher(train_loader, teacher, args.prefetch, args.teacher_threads, args.cuda)
+        test_loader = TeacherPrefetcher(test_loader, teacher, args.prefetch, args.teacher_threads, args.cuda)
+
+    def sweep_step(init=False):
+        def step(batch, epoch):
+            img, target = batch[:2]
+            if t_grad:
+                img.requires_grad = True
+
+            outs = students(img, s_taps)
+            t = batch[2] if prefetch else teacher(img)
+
+            # the students are independent, the sum of their losses gives each its own gradients;
+            # the relation matrices of the teacher are computed once for all of them
+            loss = 0.0
+            stats = OrderedDict()
+            with relation_cache():
+                for k, (s, s_args, criterionKD) in enumerate(zip(outs, sweep_args, criteria)):
+                    cls_loss = criterionCls(s['out'], target)
+                    if init:
+                        cls_loss = cls_loss * 0.0
+                    kd_loss = apply_kd(criterionKD, s, t, taps, img=img, target=target) * s_args.lambda_kd
+                    loss = loss + cls_loss + kd_loss
+                    stats['Cls{}'.format(k)] = cls_loss
+                    stats['KD{}'.format(k)] = kd_loss
+                    cls_stats(stats, s['out'], target, suffix=k)
+            return loss, stats
+        return step
+
+    modules = snets + criteria
 
-    f_l = [cls_losses.avg, kd_losses.avg, top1.avg, top5.avg]
-    logging.info('Cls: {:.4f}, KD: {:.4f}, Prec@1: {:.2f}, Prec@5: {:.2f}'.format(*f_l))
+    if args.kd_mode in ['fsp', 'ab']:
+        logging.info('The first stage, student initialization......')
 
-    return top1.avg, top5.avg
+        def adjust_lr_sweep(epoch):
+            for s_args, optimizer in zip(sweep_args, optimizers):
+                adjust_lr_init(optimizer, epoch, s_args.lr)
+        run_stage(args, train_loader, sweep_step(init=True), optimizers, 50, adjust_lr_sweep, modules)
+        for s_args in sweep_args:
+            s_args.lambda_kd = 0.0
+        logging.info('The second stage, softmax training......')
 
+    def student_meters(meters, k):
+        names = ['Cls{}', 'KD{}', 'prec{}@1', 'prec{}@5']
+        return OrderedDict((name.format(''), meters[name.format(k)]) for name in names)
 
-def adjust_lr_init(optimizer, epoch):
+    best = [(0, 0)] * len(settings)
+    step = sweep_step()
+    for epoch in range(1, args.epochs + 1):
+        logging.info('Epoch: {}  lr: {}'.format(
+            epoch, ', '.join('{:.4f}'.format(o.param_groups[0]['lr']) for o in optimizers)))
+        train_meters = train_epoch(args, train_loader, step, optimizers, epoch, modules)
+        logging.info('Testing the models......')
+        test_meters = test_epoch(args, test_loader, step, modules, t_grad)
+
+        for k, (s_args, snet, optimizer, scheduler, s_logger) in enumerate(
+                zip(sweep_args, snets, optimizers, schedulers, loggers)):
+            s_test = student_meters(test_meters, k)
+            s_logger.info('Epoch: %d  lr: %.4f', epoch, optimizer.param_groups[0]['lr'])
+            s_logger.info('train: %s', format_meters(student_meters(train_meters, k), avg_only=True))
+            s_logger.info('test: %s', format_meters(s_test, avg_only=True))
+            scheduler.step()
+
+            is_best = s_test['prec@1'].avg > best[k][0]
+            if is_best:
+                best[k] = (s_test['prec@1'].avg, s_test['prec@5'].avg)
+            save_checkpoint({
+                'epoch': epoch,
+                'snet': snet.state_dict(),
+                'prec@1': s_test['prec@1'].avg,
+                'prec@5': s_test['prec@5'].avg,
+            }, is_best, s_args.save_root)
+
+    for k, (setting, s_logger) in enumerate(zip(settings, loggers)):
+        logging.info('Student%d %s: best prec@1 %.2f, prec@5 %.2f', k, sweep_name(setting), *best[k])
+        s_logger.info('best prec@1 %.2f, prec@5 %.2f', *best[k])
+
+
+def adjust_lr_init(optimizer, epoch, lr=None):
+    lr = args.lr if lr is None else lr
     scale = 0.1
-    lr_list = [args.lr * scale] * 30
-    lr_list += [args.lr * scale * scale] * 10
-    lr_list += [args.lr * scale * scale * scale] * 10
-
-    lr = lr_list[epoch - 1]
-    logging.info('Epoch: {}  lr: {:.4f}'.format(epoch, lr))
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
+    lr_list = [lr * scale] * 30
+    lr_list += [lr * scale * scale] * 10
+    lr_list += [lr * scale * scale * scale] * 10
 
-
-# def adjust_lr(optimizer, epoch):
-#     scale = 0.1
-#     lr_list = [args.lr] * 100
-#     lr_list += [args.lr * scale] * 50
-#     lr_list += [args.lr * scale * scale] * 50
-#
-#     lr = lr_list[epoch - 1]
-#     logging.info('Epoch: {}  lr: {:.3f}'.format(epoch, lr))
-#     for param_group in optimizer.param_groups:
-#         param_group['lr'] = lr
+    set_lr([optimizer], lr_list[epoch - 1], epoch)
 
 
 if __name__ == '__main__':
-    main()
+    if args.sweep:
+        sweep_main()
+    else:
+        main()
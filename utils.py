@@ -8,18 +8,26 @@ import torch
 from models import ResNet18, ResNet101
 
 
-def define_tsnet(name, num_class, cuda=True):
+def define_tsnet(name, num_class, cuda=True, return_features=True, parallel='dp'):
+    # parallel: 'dp' DataParallel, 'ddp' DistributedDataParallel (the process group
+    # must be initialized, buffers are not broadcast on every forward, see
+    # engine.broadcast_buffers) or None for the bare net
     if name == 'resnet18':
-        net = ResNet18(num_classes=num_class)
+        net = ResNet18(num_classes=num_class, return_features=return_features)
     elif name == 'resnet101':
-        net = ResNet101(num_classes=num_class)
+        net = ResNet101(num_classes=num_class, return_features=return_features)
     else:
         raise Exception('model name does not exist.')
 
     if cuda:
-        net = torch.nn.DataParallel(net).cuda()
-    else:
+        net = net.cuda()
+    if parallel == 'dp':
         net = torch.nn.DataParallel(net)
+    elif parallel == 'ddp':
+        device_ids = [torch.cuda.current_device()] if cuda else None
+        net = torch.nn.parallel.DistributedDataParallel(net, device_ids=device_ids, broadcast_buffers=False)
+    elif parallel is not None:
+        raise Exception('Invalid parallel mode...')
 
     return net
 
@@ -52,6 +60,11 @@ def create_exp_dir(path):
 
 
 def load_pretrained_model(model, pretrained_dict):
+    # checkpoints of DataParallel/DistributedDataParallel nets prefix every key with
+    # 'module.', they are loaded into the wrapped net either way
+    if isinstance(model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
+        model = model.module
+    pretrained_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in pretrained_dict.items()}
     model_dict = model.state_dict()
     # 1. filter out unnecessary keys
     pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}